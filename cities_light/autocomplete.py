@@ -0,0 +1,506 @@
+"""
+In-memory autocomplete index of cities, ranked by population.
+
+CityIndex holds the to_search() form of the names of every city, alone and
+followed by the names of its region and country, in a sorted list. Each key
+points to the rank of its city by decreasing population. search() finds the
+keys starting with a prefix by bisection and returns the pks of the best
+ranked cities: results of prefixes which match more than scan_limit keys are
+precomputed, so that a search never looks at more keys than that.
+
+The cities_light_build_autocomplete command saves the index into a read-only
+file in DATA_DIR, which CityIndex.open() memory-maps instead of building the
+index: all processes share the same pages, and opening costs nothing.
+
+search() uses the index of the current process, opened or built on first
+use. A prebuilt file is reopened when it is replaced, which the
+cities_light command does after each import. Otherwise the index is rebuilt
+in a thread when the version file in DATA_DIR changes, which data_changed()
+does after each import. When AUTOCOMPLETE_INDEX is enabled, saving or
+deleting a country, region or city marks the index of the current process
+stale with mark_stale(), which writes nothing: DATA_DIR may be read-only
+for the web server.
+"""
+
+import array
+import bisect
+import heapq
+import json
+import mmap
+import os
+import os.path
+import struct
+import sys
+import threading
+import time
+
+from django.db import connection
+from django.db.models import signals
+
+from .models import Country, Region, City, to_search
+from .settings import *
+
+__all__ = ['CityIndex', 'search', 'data_changed', 'mark_stale']
+
+VERSION_PATH = os.path.join(DATA_DIR, 'autocomplete.version')
+INDEX_PATH = os.path.join(DATA_DIR, 'autocomplete.index')
+
+# greater than any character of a to_search() key
+KEY_END = '\x7f'
+
+
+def city_keys(names, region_name, country_name):
+    """
+    Return the set of keys of a city: each of its to_search() names, alone
+    and followed by the region and country names.
+    """
+    suffixes = ['', country_name]
+    if region_name:
+        suffixes += [region_name, region_name + country_name]
+
+    keys = set()
+    for name in names:
+        name = to_search(name)
+        if name:
+            keys.update(name + suffix for suffix in suffixes)
+    return keys
+
+
+class CityIndex(object):
+    """
+    Sorted keys with the rank of their city, see the module docstring.
+
+    keys is a sorted list of keys and ranks an array of the same length,
+    pks an array of city pks by decreasing population.
+    """
+
+    # number of results precomputed for each frequent prefix
+    top_size = 20
+
+    # maximum number of keys looked at by search()
+    scan_limit = 256
+
+    magic = 'CLAI'
+    version = 1
+    prefix = struct.Struct('<4sHQ')
+
+    def __init__(self, keys, ranks, pks, top=None):
+        self.keys = keys
+        self.ranks = ranks
+        self.pks = pks
+        self.top = top if top is not None else self.precompute()
+        self.mmap = None
+
+    @classmethod
+    def build(cls):
+        """
+        Return a CityIndex of all cities, with three queries.
+        """
+        regions = dict((pk, to_search(name))
+            for pk, name in Region.objects.values_list('pk', 'name'))
+        countries = dict((pk, to_search(name))
+            for pk, name in Country.objects.values_list('pk', 'name'))
+
+        rows = list(City.objects.order_by().values_list('pk', 'population',
+            'name', 'name_ascii', 'alternate_names', 'region_id',
+            'country_id').iterator())
+        rows.sort(key=lambda row: (-(row[1] or 0), row[0]))
+
+        pks = array.array('i')
+        entries = []
+        for rank, row in enumerate(rows):
+            pk, population, name, name_ascii, alternate_names, region_id, \
+                country_id = row
+
+            names = [name, name_ascii]
+            if alternate_names:
+                names += alternate_names.split(',')
+
+            pks.append(pk)
+            for key in city_keys(names, regions.get(region_id, ''),
+                    countries.get(country_id, '')):
+                entries.append((key, rank))
+
+        entries.sort()
+        return cls([entry[0] for entry in entries],
+            array.array('i', [entry[1] for entry in entries]), pks)
+
+    def best(self, start, end, limit):
+        """
+        Return the pks of the limit best ranked cities of keys[start:end].
+        """
+        ranks = heapq.nsmallest(limit, set(self.ranks[start:end]))
+        return [self.pks[rank] for rank in ranks]
+
+    def precompute(self):
+        """
+        Return a dict of prefix -> best pks for all prefixes which match
+        more than scan_limit keys.
+        """
+        top = {}
+        ranges = [('', 0, len(self.keys))]
+
+        while ranges:
+            prefix, start, end = ranges.pop()
+            if end - start <= self.scan_limit:
+                continue
+
+            top[prefix] = tuple(self.best(start, end, self.top_size))
+
+            depth = len(prefix) + 1
+            position = start
+            while position < end:
+                key = self.keys[position]
+                if len(key) < depth:
+                    # the prefix itself, sorted first
+                    position += 1
+                    continue
+
+                child = key[:depth]
+                child_end = bisect.bisect_left(self.keys, child + KEY_END,
+                    position, end)
+                ranges.append((child, position, child_end))
+                position = child_end
+
+        return top
+
+    def search(self, q, limit=10):
+        """
+        Return the pks of the limit most populated cities with a key
+        starting with to_search(q).
+        """
+        prefix = to_search(q)
+
+        if limit <= self.top_size and prefix in self.top:
+            return list(self.top[prefix][:limit])
+
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + KEY_END, start)
+        return self.best(start, end, limit)
+
+    def __len__(self):
+        return len(self.pks)
+
+    def save(self, path):
+        """
+        Write the index into a file, then atomically replace path with it.
+
+        The file starts with magic, version and the offset of the JSON
+        header (struct '<4sHQ'). Sections follow, each a little-endian array
+        of int32 or the concatenation of a list of strings, whose offsets
+        are given by the header: keys are stored as their offsets then their
+        data, the top prefixes the same way, with top_size pks each, padded
+        with -1.
+        """
+        top_prefixes = sorted(self.top.keys())
+        top_pks = []
+        for top_prefix in top_prefixes:
+            pks = list(self.top[top_prefix])
+            top_pks += pks + [-1] * (self.top_size - len(pks))
+
+        header = {
+            'keys': len(self.keys),
+            'cities': len(self.pks),
+            'top': len(top_prefixes),
+            'top_size': self.top_size,
+            'scan_limit': self.scan_limit,
+            'sections': {},
+        }
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.prefix.pack(self.magic, self.version, 0))
+
+            def section(name, data):
+                header['sections'][name] = f.tell()
+                f.write(data)
+
+            def ints(values, code='i'):
+                return struct.pack('<%d%s' % (len(values), code), *values)
+
+            def offsets(strings):
+                result = [0]
+                for string in strings:
+                    result.append(result[-1] + len(string))
+                return ints(result, 'I')
+
+            section('key_offsets', offsets(self.keys))
+            section('key_data', ''.join(self.keys))
+            section('ranks', ints(list(self.ranks)))
+            section('pks', ints(list(self.pks)))
+            section('top_offsets', offsets(top_prefixes))
+            section('top_data', ''.join(top_prefixes))
+            section('top_pks', ints(top_pks))
+
+            header_offset = f.tell()
+            f.write(json.dumps(header))
+
+            f.seek(0)
+            f.write(self.prefix.pack(self.magic, self.version, header_offset))
+
+        if sys.platform == 'win32' and os.path.exists(path):
+            os.unlink(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Return the CityIndex saved in path, memory-mapped: nothing is read
+        until searched. Raise ValueError if the file is not an index of this
+        version.
+        """
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, header_offset = cls.prefix.unpack_from(data, 0)
+        except struct.error:
+            magic = version = None
+
+        if magic != cls.magic or version != cls.version:
+            data.close()
+            raise ValueError('%s is not an autocomplete index version %s' % (
+                path, cls.version))
+
+        header = json.loads(data[header_offset:])
+        sections = header['sections']
+
+        keys = MappedStrings(MappedInts(data, sections['key_offsets'],
+            header['keys'] + 1, 'I'), sections['key_data'])
+        top = MappedTop(MappedStrings(MappedInts(data,
+            sections['top_offsets'], header['top'] + 1, 'I'),
+            sections['top_data']), MappedInts(data, sections['top_pks'],
+            header['top'] * header['top_size']), header['top_size'])
+
+        index = cls(keys, MappedInts(data, sections['ranks'], header['keys']),
+            MappedInts(data, sections['pks'], header['cities']), top)
+        index.top_size = header['top_size']
+        index.scan_limit = header['scan_limit']
+        index.mmap = data
+        return index
+
+
+class MappedInts(object):
+    """
+    Read-only sequence of length little-endian int32 at offset of a mmap.
+    """
+
+    def __init__(self, data, offset, length, code='i'):
+        self.data = data
+        self.offset = offset
+        self.length = length
+        self.item = struct.Struct('<' + code)
+        self.code = code
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            return list(struct.unpack_from('<%d%s' % (max(stop - start, 0),
+                self.code), self.data, self.offset + start * 4))[::step]
+
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.item.unpack_from(self.data, self.offset + i * 4)[0]
+
+
+class MappedStrings(object):
+    """
+    Read-only sequence of strings, stored as offsets relative to the data
+    offset of their mmap.
+    """
+
+    def __init__(self, offsets, offset):
+        self.offsets = offsets
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.offsets.data[self.offset + self.offsets[i]:
+            self.offset + self.offsets[i + 1]]
+
+
+class MappedTop(object):
+    """
+    Read-only prefix -> pks mapping of precomputed results, found by
+    bisection of the sorted prefixes.
+    """
+
+    def __init__(self, prefixes, pks, size):
+        self.prefixes = prefixes
+        self.pks = pks
+        self.size = size
+
+    def position(self, prefix):
+        position = bisect.bisect_left(self.prefixes, prefix)
+        if position < len(self.prefixes) and \
+                self.prefixes[position] == prefix:
+            return position
+        return None
+
+    def __contains__(self, prefix):
+        return self.position(prefix) is not None
+
+    def __getitem__(self, prefix):
+        position = self.position(prefix)
+        if position is None:
+            raise KeyError(prefix)
+
+        pks = self.pks[position * self.size:(position + 1) * self.size]
+        return tuple(pk for pk in pks if pk != -1)
+
+    def keys(self):
+        return [self.prefixes[i] for i in range(len(self.prefixes))]
+
+
+def data_version():
+    """
+    Return the modification time of the version file, or None.
+    """
+    try:
+        return os.stat(VERSION_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def index_version(path):
+    """
+    Return the modification time of a prebuilt index file, or None.
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def data_changed():
+    """
+    Touch the version file, so that processes rebuild their index. Called by
+    the cities_light command after importing.
+    """
+    if not os.path.exists(DATA_DIR):
+        os.mkdir(DATA_DIR)
+
+    with open(VERSION_PATH, 'a'):
+        os.utime(VERSION_PATH, None)
+
+
+class ReloadingIndex(object):
+    """
+    Hold the index of the process, an instance of index_class.
+
+    If path is given and the prebuilt file exists, it is opened with
+    index_class.open(path), and opened again when it is replaced. Otherwise
+    the index is built from the database with index_class.build(), and
+    rebuilt in a thread when data_version() changes or after mark_stale(),
+    the previous index being used in the meantime. Versions are checked at
+    most once every check_interval seconds.
+    """
+
+    check_interval = 1
+
+    def __init__(self, index_class, path=None):
+        self.index_class = index_class
+        self.path = path
+        self.index = None
+        self.version = None
+        self.checked = 0
+        self.changes = 0
+        self.building = False
+        self.lock = threading.Lock()
+
+    def current_version(self):
+        if self.path:
+            version = index_version(self.path)
+            if version is not None:
+                return ('file', version)
+        return ('database', data_version(), self.changes)
+
+    def mark_stale(self):
+        """
+        Rebuild the index on next use, unless it is a prebuilt file which
+        only the commands rebuild.
+        """
+        self.changes += 1
+        self.checked = 0
+
+    def build(self):
+        version = self.current_version()
+        if version[0] == 'file':
+            index = self.index_class.open(self.path)
+        else:
+            index = self.index_class.build()
+        self.index, self.version = index, version
+
+    def rebuild(self):
+        try:
+            self.build()
+        finally:
+            self.building = False
+            connection.close()
+
+    def get(self):
+        if self.index is None:
+            with self.lock:
+                if self.index is None:
+                    self.build()
+            return self.index
+
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return self.index
+        self.checked = now
+
+        with self.lock:
+            version = self.current_version()
+            if self.building or version == self.version:
+                return self.index
+
+            if version[0] == 'file':
+                # the previous mmap is closed when garbage collected, once
+                # no search uses it anymore
+                self.build()
+                return self.index
+
+            self.building = True
+
+        thread = threading.Thread(target=self.rebuild)
+        thread.daemon = True
+        thread.start()
+        return self.index
+
+reloading_index = ReloadingIndex(CityIndex, INDEX_PATH)
+
+
+def search(q, limit=10):
+    """
+    Return the pks of the limit most populated cities matching prefix q,
+    using the index of the current process.
+    """
+    return reloading_index.get().search(q, limit)
+
+
+def mark_stale(*args, **kwargs):
+    """
+    Signal receiver marking the index of the current process stale. Other
+    processes see the change after the next cities_light command.
+    """
+    reloading_index.mark_stale()
+
+if AUTOCOMPLETE_INDEX:
+    signals.post_save.connect(mark_stale, sender=Country)
+    signals.post_save.connect(mark_stale, sender=Region)
+    signals.post_save.connect(mark_stale, sender=City)
+    signals.post_delete.connect(mark_stale, sender=Country)
+    signals.post_delete.connect(mark_stale, sender=Region)
+    signals.post_delete.connect(mark_stale, sender=City)
@@ -0,0 +1,134 @@
+"""
+Bulk write helpers used by the cities_light command.
+
+Django's bulk_create() covers inserts, but there is no bulk counterpart for
+updates: bulk_update() builds a single UPDATE ... SET col = CASE pk WHEN ...
+statement per chunk of instances, skipping save() and model signals.
+
+AlternateNamesWriter uses it to merge translations into alternate_names.
+"""
+
+from django.db import connections, router, transaction
+from django.db.models import Case, F, Value, When
+
+__all__ = ['bulk_update', 'AlternateNamesWriter']
+
+
+def bulk_update(model, instances, fields):
+    """
+    Write the given fields of instances back to the database.
+
+    instances must all have a pk. fields is a list of field names. Instances
+    are grouped in chunks small enough for the database backend, each chunk
+    costs exactly one UPDATE query.
+    """
+    instances = [i for i in instances if i.pk is not None]
+    if not instances or not fields:
+        return 0
+
+    fields = [model._meta.get_field(name) for name in fields]
+    using = router.db_for_write(model)
+    connection = connections[using]
+
+    # one pk and one value parameter per field per instance, plus the pk
+    # in the WHERE clause
+    batch_size = max(1, connection.ops.bulk_batch_size(
+        ['pk'] + [f.name for f in fields] * 2, instances))
+
+    updated = 0
+    for start in range(0, len(instances), batch_size):
+        batch = instances[start:start + batch_size]
+
+        values = {}
+        for field in fields:
+            whens = [When(pk=instance.pk, then=Value(
+                getattr(instance, field.attname), output_field=field))
+                for instance in batch]
+            values[field.name] = Case(*whens, default=F(field.attname),
+                output_field=field)
+
+        updated += model._default_manager.using(using).filter(
+            pk__in=[instance.pk for instance in batch]).update(**values)
+
+    return updated
+
+
+class AlternateNamesWriter(object):
+    """
+    Merge names into the alternate_names of rows of a model, batch_size rows
+    at a time.
+
+    Each flush fetches the name and alternate_names of the pending rows with
+    one query, merges the new names in memory, skipping names already there
+    and the row's own name, and writes back the rows that changed with
+    bulk_update(). Model signals are not sent, the pks of the rows that
+    changed are collected in self.changed.
+    """
+
+    def __init__(self, model, batch_size):
+        self.model = model
+        self.batch_size = batch_size
+        self.pending = {}
+        self.removed = {}
+        self.updated = 0
+        self.changed = set()
+
+    def add(self, pk, names):
+        """
+        Queue names, an iterable of unicode, for the row with pk.
+        """
+        self.pending.setdefault(pk, []).extend(names)
+
+        if len(self.pending) + len(self.removed) >= self.batch_size:
+            self.flush()
+
+    def remove(self, pk, names):
+        """
+        Queue names, an iterable of unicode, to remove from the row with pk.
+        """
+        self.removed.setdefault(pk, set()).update(names)
+
+        if len(self.pending) + len(self.removed) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending rows, return the number of rows that changed.
+        """
+        pending, self.pending = self.pending, {}
+        removed, self.removed = self.removed, {}
+        if not pending and not removed:
+            return 0
+
+        changed = []
+        rows = self.model.objects.filter(
+            pk__in=set(pending.keys()) | set(removed.keys())).values_list(
+            'pk', 'name', 'alternate_names')
+        for pk, name, current in rows:
+            if current:
+                alternate_names = current.split(',')
+            else:
+                alternate_names = []
+
+            if pk in removed:
+                alternate_names = [n for n in alternate_names
+                    if n not in removed[pk]]
+
+            known = set(alternate_names)
+            known.add(name)
+
+            for new_name in pending.get(pk, []):
+                if new_name not in known:
+                    known.add(new_name)
+                    alternate_names.append(new_name)
+
+            alternate_names = u','.join(alternate_names)
+            if alternate_names != current:
+                changed.append(self.model(pk=pk,
+                    alternate_names=alternate_names))
+
+        with transaction.atomic():
+            bulk_update(self.model, changed, ['alternate_names'])
+        self.updated += len(changed)
+        self.changed.update(instance.pk for instance in changed)
+        return len(changed)
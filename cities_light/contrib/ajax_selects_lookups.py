@@ -11,6 +11,9 @@ from ajax_select import LookupChannel
 from django.db.models import Q
 
 from ..models import *
+from ..settings import *
+from .. import autocomplete
+from ..search import search_cities
 
 
 class StandardLookupChannel(LookupChannel):
@@ -59,10 +62,15 @@ class RegionLookup(StandardLookupChannel):
 
 class CityLookup(StandardLookupChannel):
     """
-    Lookup channel for City, hits name and search_names.
+    Lookup channel for City, hits search_names with cities_light.search, or
+    the cities_light.autocomplete index if AUTOCOMPLETE_INDEX is enabled.
     """
     model = City
 
     def get_query(self, q, request):
-        return City.objects.filter(search_names__icontains=q
-            ).select_related('country').distinct()
+        if AUTOCOMPLETE_INDEX:
+            return City.objects.filter(pk__in=autocomplete.search(q,
+                autocomplete.CityIndex.top_size)).select_related(
+                'country').order_by('-population')
+
+        return search_cities(q, City.objects.select_related('country'))
@@ -1,4 +1,7 @@
 from ..models import Country, Region, City
+from ..settings import *
+from .. import autocomplete
+from ..search import search_cities
 
 import autocomplete_light
 
@@ -6,6 +9,20 @@ import autocomplete_light
 class CityAutocomplete(autocomplete_light.AutocompleteModelBase):
     search_fields = ('search_names',)
 
+    def choices_for_request(self):
+        """
+        Return the most populated cities matching q, from the
+        cities_light.autocomplete index if AUTOCOMPLETE_INDEX is enabled,
+        with cities_light.search otherwise.
+        """
+        q = self.request.GET.get('q', '')
+
+        if not AUTOCOMPLETE_INDEX:
+            return search_cities(q, self.choices)[:self.limit_choices]
+
+        pks = autocomplete.search(q, self.limit_choices)
+        return self.choices.filter(pk__in=pks).order_by('-population')
+
 
 class RegionAutocomplete(autocomplete_light.AutocompleteModelBase):
     search_fields = ('name', 'name_ascii')
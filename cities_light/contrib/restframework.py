@@ -5,6 +5,7 @@ It defines a urlpatterns variables, with the following urls:
 
 - cities_light_api_city_list
 - cities_light_api_city_detail
+- cities_light_api_city_nearest
 - cities_light_api_region_list
 - cities_light_api_region_detail
 - cities_light_api_country_list
@@ -21,11 +22,17 @@ And that's all !
 from django.conf.urls.defaults import patterns, url
 from django.core import urlresolvers
 
-from djangorestframework.views import ModelView, ListModelView
+from djangorestframework import status
+from djangorestframework.views import View, ModelView, ListModelView
 from djangorestframework.mixins import InstanceMixin, ReadModelMixin
 from djangorestframework.resources import ModelResource
+from djangorestframework.response import ErrorResponse
 
 from ..models import Country, Region, City
+from ..settings import *
+from .. import autocomplete
+from .. import spatial
+from ..search import search_cities
 
 
 class CityResource(ModelResource):
@@ -88,25 +95,42 @@ class CitiesLightListModelView(ListModelView):
         Limit the results returned by the parent get(), using the limit GET
         argument.
         """
-        limit = request.GET.get('limit', None)
-        queryset = super(CitiesLightListModelView, self).get(
-            request, *args, **kwargs)
+        limit = self.limit(request)
+        queryset = self.search(request, super(CitiesLightListModelView,
+            self).get(request, *args, **kwargs))
 
         if limit:
             return queryset[:limit]
         else:
             return queryset
 
-    def get_query_kwargs(self, request, *args, **kwargs):
+    def limit(self, request, default=None):
+        """
+        Return the limit GET argument as an integer, or default if it is
+        missing. Respond 400 if it is not a positive integer.
+        """
+        limit = request.GET.get('limit', None)
+        if not limit:
+            return default
+
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+
+        if limit < 1:
+            raise ErrorResponse(status.HTTP_400_BAD_REQUEST,
+                {'detail': 'limit must be a positive integer'})
+        return limit
+
+    def search(self, request, queryset):
         """
         Allows a GET param, 'q', to be used against name_ascii.
         """
-        kwargs = super(ListModelView, self).get_query_kwargs(request, *args,
-            **kwargs)
         if 'q' in request.GET.keys():
-            kwargs['name_ascii__icontains'] = request.GET['q']
+            queryset = queryset.filter(name_ascii__icontains=request.GET['q'])
 
-        return kwargs
+        return queryset
 
 
 class CityListModelView(CitiesLightListModelView):
@@ -114,17 +138,157 @@ class CityListModelView(CitiesLightListModelView):
     ListModelView for City.
     """
 
-    def get_query_kwargs(self, request, *args, **kwargs):
+    def search(self, request, queryset):
         """
-        Allows a GET param, 'q', to be used against search_names.
+        Allows a GET param, 'q', to be used against search_names with
+        cities_light.search, or the cities_light.autocomplete index if
+        AUTOCOMPLETE_INDEX is enabled. Cities are returned in the order of
+        either, most populated first.
         """
-        kwargs = super(ListModelView, self).get_query_kwargs(request, *args,
-            **kwargs)
+        if 'q' not in request.GET.keys():
+            return queryset
 
-        if 'q' in request.GET.keys():
-            kwargs['search_names__icontains'] = request.GET['q']
+        if AUTOCOMPLETE_INDEX:
+            limit = self.limit(request, autocomplete.CityIndex.top_size)
+            return queryset.filter(pk__in=autocomplete.search(
+                request.GET['q'], limit)).order_by('-population', 'pk')
+
+        return search_cities(request.GET['q'], queryset)
+
+
+class CityNearestView(View):
+    """
+    Return the cities nearest to a position, or to each position of a batch,
+    found with cities_light.spatial rather than by querying all cities.
+
+    GET or POST arguments:
+
+    lat, lon
+        Position, in degrees.
+    coordinates
+        Instead of lat and lon, a batch of positions as 'lat,lon;lat,lon',
+        or a list of [lat, lon] pairs in a JSON body.
+    k
+        Number of cities to return per position, from 1, the default, to
+        max_k.
+    min_population
+        Ignore cities with less inhabitants.
+
+    The response is the list of the k nearest cities, closest first, with
+    their distance in kilometers. For a batch, it is the list of these
+    lists, in the order of the positions.
+
+    The JSON body of a POST request can also be the bare list of [lat, lon]
+    pairs, with the other arguments in GET.
+    """
+
+    max_k = 100
+    max_coordinates = 1000
+
+    def get(self, request, *args, **kwargs):
+        return self.nearest(request.GET)
+
+    def post(self, request, *args, **kwargs):
+        data = self.DATA
+        if isinstance(data, (list, tuple)):
+            data = dict(request.GET.items(), coordinates=data)
+        elif not isinstance(data, dict):
+            raise self.error('the body must be an object or a list of '
+                'coordinates')
+        return self.nearest(data)
 
-        return kwargs
+    def error(self, message):
+        return ErrorResponse(status.HTTP_400_BAD_REQUEST,
+            {'detail': message})
+
+    def integer(self, data, name, default, minimum=0, maximum=None):
+        value = data.get(name, None)
+        if value in (None, ''):
+            value = default
+
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise self.error('%s must be an integer' % name)
+
+        if maximum is None and value < minimum:
+            raise self.error('%s must be at least %s' % (name, minimum))
+        elif maximum is not None and not minimum <= value <= maximum:
+            raise self.error('%s must be between %s and %s' % (name,
+                minimum, maximum))
+        return value
+
+    def coordinates(self, data):
+        """
+        Return the list of (latitude, longitude) of the request, and whether
+        it is a batch.
+        """
+        coordinates = data.get('coordinates', None)
+        batch = coordinates is not None
+
+        if not batch:
+            coordinates = [(data.get('lat', None), data.get('lon', None))]
+        elif isinstance(coordinates, basestring):
+            coordinates = [pair.split(',')
+                for pair in coordinates.split(';') if pair]
+        elif not isinstance(coordinates, (list, tuple)):
+            raise self.error('coordinates must be a list of [lat, lon]')
+
+        if len(coordinates) > self.max_coordinates:
+            raise self.error('at most %s coordinates per request' %
+                self.max_coordinates)
+
+        result = []
+        for pair in coordinates:
+            # a string pair would be iterated character by character
+            if not isinstance(pair, (list, tuple)) or len(pair) != 2 or \
+                    any(isinstance(value, bool) for value in pair):
+                raise self.error('invalid coordinates %s' % (pair,))
+
+            try:
+                latitude, longitude = [float(value) for value in pair]
+            except (TypeError, ValueError):
+                raise self.error('invalid coordinates %s' % (pair,))
+
+            if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+                raise self.error('coordinates out of range %s' % (pair,))
+
+            result.append((latitude, longitude))
+
+        return result, batch
+
+    def city_data(self, city, distance):
+        return {
+            'id': city.pk,
+            'name': city.name,
+            'display_name': city.display_name,
+            'population': city.population,
+            'latitude': float(city.latitude),
+            'longitude': float(city.longitude),
+            'distance': round(distance, 3),
+            'url': urlresolvers.reverse('cities_light_api_city_detail',
+                args=(city.pk,)),
+        }
+
+    def nearest(self, data):
+        coordinates, batch = self.coordinates(data)
+        k = self.integer(data, 'k', 1, 1, self.max_k)
+        min_population = self.integer(data, 'min_population', 0)
+
+        results = [spatial.nearest(latitude, longitude, k, min_population)
+            for latitude, longitude in coordinates]
+
+        # one query for the cities of the whole batch
+        cities = City.objects.in_bulk(set(pk for result in results
+            for pk, distance in result))
+
+        response = [[self.city_data(cities[pk], distance)
+            for pk, distance in result if pk in cities]
+            for result in results]
+
+        if batch:
+            return response
+        return response[0]
 
 urlpatterns = patterns('',
     url(
@@ -132,6 +296,11 @@ urlpatterns = patterns('',
         CityListModelView.as_view(resource=CityResource),
         name='cities_light_api_city_list',
     ),
+    url(
+        r'^city/nearest/$',
+        CityNearestView.as_view(),
+        name='cities_light_api_city_nearest',
+    ),
     url(
         r'^city/(?P<pk>[^/]+)/$',
         DetailView.as_view(resource=CityResource),
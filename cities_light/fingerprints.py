@@ -0,0 +1,92 @@
+"""
+Fingerprints of the source rows imported by the cities_light command.
+
+For each geoname_id of a source file, a 64 bit hash of its row is kept in a
+file next to it in DATA_DIR. On the next import, rows whose hash did not
+change can be skipped before any database work.
+"""
+
+import hashlib
+import os
+import struct
+import sys
+
+__all__ = ['Fingerprints']
+
+
+class Fingerprints(object):
+    """
+    geoname_id -> row hash map, loaded from and saved to path.
+
+    The file is a sequence of struct '<IQ' records: geoname_id and hash.
+    check() compares a row with the previous import and counts new, changed
+    and unchanged rows.
+    """
+
+    NEW = 'new'
+    CHANGED = 'changed'
+    UNCHANGED = 'unchanged'
+
+    record = struct.Struct('<IQ')
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}
+        self.counts = {self.NEW: 0, self.CHANGED: 0, self.UNCHANGED: 0}
+
+    def load(self):
+        """
+        Read the hashes of the previous import if any, return self.
+        """
+        if not os.path.exists(self.path):
+            return self
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        size = self.record.size
+        for offset in range(0, len(data) - len(data) % size, size):
+            geoname_id, row_hash = self.record.unpack_from(data, offset)
+            self.hashes[geoname_id] = row_hash
+
+        return self
+
+    def hash(self, items):
+        line = '\t'.join(items)
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+
+        digest = hashlib.md5(line).digest()
+        return struct.unpack('<Q', digest[:8])[0]
+
+    def check(self, geoname_id, items):
+        """
+        Store the hash of items for geoname_id and return NEW, CHANGED or
+        UNCHANGED compared with the previous import.
+        """
+        row_hash = self.hash(items)
+        previous = self.hashes.get(geoname_id, None)
+        self.hashes[geoname_id] = row_hash
+
+        if previous is None:
+            status = self.NEW
+        elif previous != row_hash:
+            status = self.CHANGED
+        else:
+            status = self.UNCHANGED
+
+        self.counts[status] += 1
+        return status
+
+    def save(self):
+        """
+        Atomically replace the file with the current hashes.
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for geoname_id, row_hash in self.hashes.items():
+                f.write(self.record.pack(geoname_id, row_hash))
+
+        if sys.platform == 'win32' and os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rename(tmp_path, self.path)
@@ -1,10 +1,22 @@
-import time
-import urllib
+import calendar
+import json
 import os
 import os.path
 import zipfile
 import logging
+import multiprocessing
 import sys
+import threading
+from email.utils import formatdate, parsedate
+from functools import partial
+
+try:
+    from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+from django.utils.encoding import force_unicode
 
 from .settings import *
 
@@ -12,56 +24,150 @@ from .settings import *
 class Geonames(object):
     logger = logging.getLogger('cities_light')
 
-    def __init__(self, url, force=False):
+    def __init__(self, url, force=False, extract=None):
+        """
+        Download url into DATA_DIR.
+
+        A zip is extracted next to it if extract is True, defaults to
+        EXTRACT_SOURCES, otherwise its rows are decompressed on the fly by
+        parse() and self.member is the name of the file in the archive.
+        """
         if not os.path.exists(DATA_DIR):
             self.logger.info('Creating %s' % DATA_DIR)
             os.mkdir(DATA_DIR)
 
+        if extract is None:
+            extract = EXTRACT_SOURCES
+
         destination_file_name = url.split('/')[-1]
         self.file_path = os.path.join(DATA_DIR,
             destination_file_name)
+        self.member = None
 
         self.downloaded = self.download(url, self.file_path, force)
 
-        # extract the destination file, use the extracted file as new
-        # destination
+        if url.split('.')[-1] != 'zip':
+            return
+
         destination_file_name = destination_file_name.replace(
             'zip', 'txt')
 
+        if not extract:
+            self.member = destination_file_name
+            return
+
+        # extract the destination file, use the extracted file as new
+        # destination
         destination = os.path.join(DATA_DIR, destination_file_name)
         exists = os.path.exists(destination)
 
-        if url.split('.')[-1] == 'zip' and not exists:
+        if self.downloaded or not exists:
             self.extract(self.file_path, destination_file_name)
 
-        self.file_path = os.path.join(
-            DATA_DIR, destination_file_name)
+        self.file_path = destination
+
+    # bytes read from the network and written to disk at once
+    download_chunk_size = 64 * 1024
 
     def download(self, url, path, force=False):
-        remote_file = urllib.urlopen(url)
-        remote_time = time.strptime(remote_file.headers['last-modified'],
-            '%a, %d %b %Y %H:%M:%S %Z')
-        remote_size = int(remote_file.headers['content-length'])
+        """
+        Download url into path if it changed on the server, return True if it
+        was downloaded.
+
+        The request is conditional on the ETag and Last-Modified of the
+        previous download, stored in path.meta, unless force is True. The
+        body is streamed into path.part, which is renamed to path once
+        complete: an interrupted download is resumed with a Range request,
+        if the server still has the same version of the file.
+        """
+        meta = self.read_meta(path)
+        part_path = path + '.part'
+        headers = {}
 
         if os.path.exists(path) and not force:
-            local_time = time.gmtime(os.path.getmtime(path))
-            local_size = os.path.getsize(path)
+            if meta.get('etag', None):
+                headers['If-None-Match'] = meta['etag']
+            headers['If-Modified-Since'] = meta.get('last-modified',
+                None) or formatdate(os.path.getmtime(path), usegmt=True)
 
-            if local_time >= remote_time and local_size == remote_size:
+        offset = 0
+        validator = meta.get('part-etag', None) or meta.get(
+            'part-last-modified', None)
+        if os.path.exists(part_path) and validator:
+            offset = os.path.getsize(part_path)
+            headers['Range'] = 'bytes=%s-' % offset
+            headers['If-Range'] = validator
+
+        try:
+            remote_file = urlopen(Request(url, headers=headers))
+        except HTTPError as e:
+            if e.code == 304:
                 self.logger.warning(
                     'Assuming local download is up to date for %s' % url)
-
                 return False
+            elif e.code == 416 and offset:
+                # the partial download is no good, start over
+                os.unlink(part_path)
+                return self.download(url, path, force)
+            raise
+
+        if remote_file.getcode() != 206:
+            # the server ignored the Range, or the file changed
+            offset = 0
 
-        self.logger.info('Downloading %s into %s' % (url, path))
-        with open(path, 'wb') as local_file:
-            chunk = remote_file.read()
+        meta['part-etag'] = remote_file.info().get('etag', None)
+        meta['part-last-modified'] = remote_file.info().get('last-modified',
+            None)
+        self.write_meta(path, meta)
+
+        if offset:
+            self.logger.info('Resuming download of %s into %s at %s' % (
+                url, path, offset))
+        else:
+            self.logger.info('Downloading %s into %s' % (url, path))
+
+        with open(part_path, 'ab' if offset else 'wb') as local_file:
+            chunk = remote_file.read(self.download_chunk_size)
             while chunk:
                 local_file.write(chunk)
-                chunk = remote_file.read()
+                chunk = remote_file.read(self.download_chunk_size)
+
+        length = remote_file.info().get('content-length', None)
+        if length is not None and os.path.getsize(part_path) != offset + int(
+                length):
+            raise IOError('Incomplete download of %s, run again to resume' %
+                url)
+
+        if sys.platform == 'win32' and os.path.exists(path):
+            os.unlink(path)
+        os.rename(part_path, path)
+
+        meta = {
+            'etag': meta.pop('part-etag'),
+            'last-modified': meta.pop('part-last-modified'),
+        }
+        self.write_meta(path, meta)
+
+        if meta['last-modified']:
+            remote_time = calendar.timegm(parsedate(meta['last-modified']))
+            os.utime(path, (remote_time, remote_time))
 
         return True
 
+    def read_meta(self, path):
+        """
+        Return the dict of HTTP validators stored for path.
+        """
+        try:
+            with open(path + '.meta', 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_meta(self, path, meta):
+        with open(path + '.meta', 'w') as f:
+            json.dump(meta, f)
+
     def extract(self, zip_path, file_name):
         destination = os.path.join(DATA_DIR, file_name)
 
@@ -72,17 +178,197 @@ class Geonames(object):
         if zip_file:
             zip_file.extract(file_name, DATA_DIR)
 
-    def parse(self):
-        file = open(self.file_path, 'r')
-        line = True
+    def parse(self, workers=1, row_filter=None):
+        """
+        Yield the list of fields of each line of the file, skipping blank
+        lines and comments. If row_filter is set, each row is replaced by
+        row_filter(items), and skipped if that is None.
+
+        With more than one worker, the file is split in chunks which are
+        tokenized and filtered by a pool of processes, rows are still
+        yielded in order. row_filter must then be picklable.
+
+        self.position is the number of bytes consumed so far, to report
+        progress against self.size() without reading the file twice.
+        """
+        self.position = 0
+
+        if workers > 1:
+            for end, rows in self.parallel_parse(workers, row_filter):
+                for items in rows:
+                    yield items
+                self.position = end
+            return
+
+        for line in self.open():
+            self.position += len(line)
+
+            items = parse_line(line, row_filter)
+            if items is not None:
+                yield items
+
+    # bytes of file read by a parse worker at once
+    chunk_size = 4 * 1024 * 1024
 
-        for line in file:
-            line = line.strip()
+    def chunks(self):
+        """
+        Return a list of (path, start, end) byte ranges covering the file,
+        each ending on a line boundary.
+        """
+        size = os.path.getsize(self.file_path)
+        chunks = []
 
-            if len(line) < 1 or line[0] == '#':
-                continue
+        with open(self.file_path, 'rb') as f:
+            start = 0
+            while start < size:
+                f.seek(min(start + self.chunk_size, size))
+                f.readline()
+                end = min(f.tell(), size)
+                chunks.append((self.file_path, start, end))
+                start = end
 
-            yield [e.strip() for e in line.split('\t')]
+        return chunks
+
+    def read_chunks(self):
+        """
+        Yield strings of about chunk_size bytes of the file, each ending on
+        a line boundary. Used for zip members, which can't be seeked.
+        """
+        file = self.open()
+
+        while True:
+            data = file.read(self.chunk_size)
+            if not data:
+                break
+            yield data + file.readline()
+
+    def parallel_parse(self, workers, row_filter=None):
+        """
+        Yield (end, rows) for each chunk, in file order, parsed by a pool of
+        workers processes. end is the offset of the end of the chunk.
+
+        At most 2 * workers chunks are read or parsed ahead of the consumer,
+        so that memory stays bounded when it is slower than the workers.
+        """
+        pool = multiprocessing.Pool(workers)
+        in_flight = threading.Semaphore(2 * workers)
+        stopped = []
+
+        if self.member:
+            chunks = self.read_chunks()
+        else:
+            chunks = self.chunks()
+
+        def throttled(chunks):
+            # consumed by the task handler thread of the pool
+            for chunk in chunks:
+                in_flight.acquire()
+                if stopped:
+                    return
+                yield chunk
+
+        try:
+            end = 0
+            for length, rows in pool.imap(partial(parse_chunk,
+                    row_filter=row_filter), throttled(chunks)):
+                end += length
+                yield end, rows
+                in_flight.release()
+        finally:
+            stopped.append(True)
+            in_flight.release()
+            pool.terminate()
+
+    def open(self):
+        """
+        Return a file object for the rows, decompressing the zip member
+        on the fly if the archive was not extracted.
+        """
+        if self.member:
+            # the ZipFile must stay referenced while its member is read
+            self.zip_file = zipfile.ZipFile(self.file_path)
+            return self.zip_file.open(self.member)
+
+        return open(self.file_path, 'r')
+
+    def size(self):
+        """
+        Return the size of the file in bytes, the maximum of self.position.
+        """
+        if self.member:
+            return zipfile.ZipFile(self.file_path).getinfo(
+                self.member).file_size
+
+        return os.path.getsize(self.file_path)
 
     def num_lines(self):
-        return sum(1 for line in open(self.file_path))
+        """
+        Return the number of lines of the file, reading it all: prefer
+        size() and position to report progress.
+        """
+        return sum(1 for line in self.open())
+
+
+def parse_line(line, row_filter=None):
+    """
+    Return the list of fields of a line of a geonames file, passed through
+    row_filter if set, or None if it is blank, a comment or rejected by
+    row_filter.
+    """
+    line = line.strip()
+
+    if len(line) < 1 or line[0] == '#':
+        return None
+
+    items = [e.strip() for e in line.split('\t')]
+
+    if row_filter is not None:
+        return row_filter(items)
+
+    return items
+
+
+def parse_chunk(chunk, row_filter=None):
+    """
+    Return (length, rows) for a chunk of a geonames file, parsed like
+    Geonames.parse() does. chunk is either the data itself, or a (path,
+    start, end) byte range of the file to read. Module level to be picklable
+    by multiprocessing.
+    """
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+    else:
+        data = chunk
+
+    rows = []
+    for line in data.split('\n'):
+        items = parse_line(line, row_filter)
+        if items is not None:
+            rows.append(items)
+
+    return len(data), rows
+
+
+class AlternateNamesFilter(object):
+    """
+    Row filter of alternateNames files, picklable for parse workers.
+
+    Keeps the names in languages, skipping short, colloquial and historic
+    names, and converts the geoname_id to int and the name to unicode.
+    """
+
+    def __init__(self, languages):
+        self.languages = frozenset(languages)
+
+    def __call__(self, items):
+        # flags of short, colloquial and historic names follow the name
+        if len(items) > 4 or items[2] not in self.languages:
+            return None
+
+        items[1] = int(items[1])
+        items[3] = force_unicode(items[3])
+        return items
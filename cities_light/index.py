@@ -0,0 +1,264 @@
+"""
+Import-time indexes of the rows already in the database.
+
+The cities_light command loads one ModelIndex per model before parsing, with
+a single streaming query each, so that finding out if a parsed row already
+exists is a dict lookup rather than a get() query.
+"""
+
+from .models import Country, Region, City
+
+__all__ = ['IdentityMap', 'ModelIndex', 'ImportIndex']
+
+
+class IdentityMap(object):
+    """
+    Complete key -> pk map for one key of a model.
+
+    A key with a single field is looked up with the bare value, others with
+    a tuple of values. Membership tests are dict lookups. map[key] raises
+    model.DoesNotExist for unknown keys, after checking the database once in
+    case the row was created behind our back: the miss is remembered so that
+    the same unknown key never queries again.
+    """
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = tuple(fields)
+        self.pks = {}
+        self.misses = set()
+
+    def key(self, values):
+        """
+        Return the key for a dict of field values, or None if any of them is
+        empty.
+        """
+        key = []
+        for field in self.fields:
+            value = values.get(field, None)
+            if value is None or value == '':
+                return None
+            key.append(value)
+
+        if len(key) == 1:
+            return key[0]
+        return tuple(key)
+
+    def add(self, key, pk):
+        """
+        Map key to pk. The first pk added for a key wins, as with filter()[0]
+        style lookups.
+        """
+        self.pks.setdefault(key, pk)
+        self.misses.discard(key)
+
+    def discard(self, key):
+        """
+        Forget key, ie. because its row was deleted.
+        """
+        self.pks.pop(key, None)
+
+    def get(self, key, default=None):
+        """
+        Return the pk for key or default, never queries.
+        """
+        return self.pks.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.pks
+
+    def __getitem__(self, key):
+        try:
+            return self.pks[key]
+        except KeyError:
+            pass
+
+        if key not in self.misses:
+            values = key if len(self.fields) > 1 else (key,)
+            pks = self.model.objects.filter(
+                **dict(zip(self.fields, values))).values_list('pk', flat=True)
+
+            for pk in pks[:1]:
+                self.add(key, pk)
+                return pk
+
+            self.misses.add(key)
+
+        raise self.model.DoesNotExist('%s matching %s=%s does not exist' % (
+            self.model.__name__, self.fields, key))
+
+    def __len__(self):
+        return len(self.pks)
+
+
+class ModelIndex(object):
+    """
+    IdentityMaps for several keys of one model.
+
+    Keys are declared as keyword arguments, name=fields, fields being a tuple
+    of field attnames. Rows for which any field of a key is empty are not
+    indexed under that key.
+
+    The attnames in values are loaded too, value(pk, field) returns them.
+    """
+
+    def __init__(self, model, values=(), **keys):
+        self.model = model
+        self.maps = dict((name, IdentityMap(model, fields))
+            for name, fields in keys.items())
+        self.value_fields = tuple(values)
+        self.values = {}
+
+    def __getitem__(self, name):
+        return self.maps[name]
+
+    def fields(self):
+        """
+        Return the attnames of values and of every key.
+        """
+        fields = list(self.value_fields)
+        for identity_map in self.maps.values():
+            for field in identity_map.fields:
+                if field not in fields:
+                    fields.append(field)
+        return fields
+
+    def load(self):
+        """
+        Fill all maps with one streaming query, return self.
+        """
+        fields = self.fields()
+        queryset = self.model.objects.order_by().values_list('pk', *fields)
+        for row in queryset.iterator():
+            self.add(row[0], **dict(zip(fields, row[1:])))
+
+        return self
+
+    def add(self, pk, **values):
+        """
+        Index pk with the given field values.
+        """
+        for identity_map in self.maps.values():
+            key = identity_map.key(values)
+            if key is not None:
+                identity_map.add(key, pk)
+
+        if self.value_fields:
+            self.values[pk] = tuple(values.get(field, None)
+                for field in self.value_fields)
+
+    def add_instance(self, instance):
+        """
+        Index a model instance which has a pk.
+        """
+        values = dict((field, getattr(instance, field))
+            for field in self.value_fields)
+        for identity_map in self.maps.values():
+            for field in identity_map.fields:
+                values[field] = getattr(instance, field)
+
+        if values.get('geoname_id', None):
+            values['geoname_id'] = int(values['geoname_id'])
+
+        self.add(instance.pk, **values)
+
+    def discard(self, pk, **values):
+        """
+        Forget pk under every key and its values, ie. because its row was
+        deleted.
+
+        If the field values pk was indexed with are given, only their keys
+        are looked up, otherwise every map is scanned.
+        """
+        for identity_map in self.maps.values():
+            if values:
+                keys = [identity_map.key(values)]
+            else:
+                keys = [key for key, value in identity_map.pks.items()
+                    if value == pk]
+
+            for key in keys:
+                if key is not None and identity_map.get(key) == pk:
+                    identity_map.discard(key)
+
+        self.values.pop(pk, None)
+
+    def get(self, name, value):
+        """
+        Return the pk indexed with value under key name, or None.
+
+        Values must have the database type, ie. geoname ids parsed from a
+        file should be converted to int.
+        """
+        return self.maps[name].get(value, None)
+
+    def value(self, pk, field):
+        """
+        Return the value of field, which must be in values, for pk.
+        """
+        return self.values[pk][self.value_fields.index(field)]
+
+
+class ImportIndex(object):
+    """
+    ModelIndex for Country, Region and City, with the keys the cities_light
+    command matches rows on.
+
+    Country and Region indexes are also the identity maps for code2 ->
+    country and (country, admin1 code) -> region, loaded with two queries,
+    and hold their names and alternate names to denormalize them without
+    queries. The City index holds the country and region of each city, to
+    tell whether a row would fill a blank foreign key.
+    """
+
+    def __init__(self):
+        self.countries = ModelIndex(Country,
+            values=('name', 'alternate_names'),
+            geoname_id=('geoname_id',),
+            code2=('code2',))
+        self.regions = ModelIndex(Region,
+            values=('name', 'country_id', 'alternate_names'),
+            geoname_id=('geoname_id',),
+            name=('country_id', 'name'),
+            code=('country_id', 'geoname_code'))
+        self.cities = ModelIndex(City,
+            values=('country_id', 'region_id'),
+            geoname_id=('geoname_id',),
+            name=('name', 'country_id', 'region_id'),
+            country_name=('name', 'country_id'))
+
+    def load(self):
+        """
+        Load all three indexes, return self.
+        """
+        for index in (self.countries, self.regions, self.cities):
+            index.load()
+        return self
+
+    def geoname_models(self):
+        """
+        Return a dict of geoname_id -> model class for all indexed rows, to
+        classify alternate names with a single lookup. A geoname_id present
+        in several models is classified as Country, then Region, then City.
+        """
+        models = {}
+        for model_class, index in ((City, self.cities),
+                (Region, self.regions), (Country, self.countries)):
+            for geoname_id in index['geoname_id'].pks:
+                models[geoname_id] = model_class
+        return models
+
+    def country_id(self, code2):
+        """
+        Return the pk of the country with code2, or raise
+        Country.DoesNotExist.
+        """
+        return self.countries['code2'][code2]
+
+    def region_id(self, country_code2, geoname_code):
+        """
+        Return the pk of the region with geoname_code in the country with
+        country_code2, or raise Country.DoesNotExist or Region.DoesNotExist.
+        """
+        return self.regions['code'][
+            (self.country_id(country_code2), geoname_code)]
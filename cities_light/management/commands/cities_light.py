@@ -1,27 +1,34 @@
+import datetime
+import itertools
 import os
 import os.path
 import logging
 import optparse
 import sys
+from multiprocessing.pool import ThreadPool
 if sys.platform != 'win32':
     import resource
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 import progressbar
 
 from django.core.management.base import BaseCommand
-from django.db import transaction, reset_queries
+from django.db import transaction, reset_queries, router
+from django.db.models import signals
 from django.utils.encoding import force_unicode
 
 from ...exceptions import *
 from ...signals import *
 from ...models import *
+from ...models import set_name_ascii, set_display_name, city_country, \
+    city_search_names, set_scaled_coordinates, names_by_pk, \
+    update_search_names
 from ...settings import *
-from ...geonames import Geonames
+from ...geonames import Geonames, AlternateNamesFilter
+from ...bulk import bulk_update, AlternateNamesWriter
+from ...index import ImportIndex
+from ...fingerprints import Fingerprints
+from ...translations import TranslationBuffer, TranslationCache
+from ...autocomplete import CityIndex, INDEX_PATH, data_changed
 
 
 class MemoryUsageWidget(progressbar.ProgressBarWidget):
@@ -53,6 +60,11 @@ It is possible to force the import of files which weren't downloaded using the
 --force-import option:
 
     manage.py --force-import cities15000 --force-import country
+
+Once the database is populated, the --delta option applies only the daily
+modification and deletion files published by GeoNames since the last run:
+
+    manage.py cities_light --delta
     '''.strip()
 
     logger = logging.getLogger('cities_light')
@@ -78,6 +90,41 @@ It is possible to force the import of files which weren't downloaded using the
             default=False,
             help='Set this if you intend to import translations a lot'
         ),
+        optparse.make_option('--batch-size', action='store', type='int',
+            default=IMPORT_BATCH_SIZE,
+            help='Number of rows to resolve and write at once'
+        ),
+        optparse.make_option('--no-signals', action='store_true',
+            default=False,
+            help='Compute denormalized city fields without sending pre_save'
+        ),
+        optparse.make_option('--transaction-size', action='store',
+            type='int', default=IMPORT_TRANSACTION_SIZE,
+            help='Number of rows to import per transaction'
+        ),
+        optparse.make_option('--translation-memory-limit', action='store',
+            type='int', default=TRANSLATION_MEMORY_LIMIT,
+            help='Megabytes of translations to hold before spilling to disk'
+        ),
+        optparse.make_option('--workers', action='store', type='int',
+            default=1,
+            help='Number of processes to parse alternateNames with, other '
+                'sources are always parsed by the command process'
+        ),
+        optparse.make_option('--download-workers', action='store',
+            type='int', default=4,
+            help='Number of files to download and extract at the same time'
+        ),
+        optparse.make_option('--no-extract', action='store_true',
+            default=False,
+            help='Read zip sources without extracting them to disk'
+        ),
+        optparse.make_option('--delta', action='store_true', default=False,
+            help='Apply the daily modification and deletion files only'
+        ),
+        optparse.make_option('--delta-since', action='store', default=None,
+            help='YYYY-MM-DD, first day to apply if no delta was applied yet'
+        ),
     )
 
     def handle(self, *args, **options):
@@ -85,20 +132,19 @@ It is possible to force the import of files which weren't downloaded using the
             self.logger.info('Creating %s' % DATA_DIR)
             os.mkdir(DATA_DIR)
 
-        translation_hack_path = os.path.join(DATA_DIR, 'translation_hack')
+        translation_cache = TranslationCache(
+            os.path.join(DATA_DIR, 'translation_hack'))
+        translation_cache_source = None
 
-        self.noinsert = options.get('noinsert', False)
-        self.widgets = [
-            'RAM used: ',
-            MemoryUsageWidget(),
-            ' ',
-            progressbar.ETA(),
-            ' Done: ',
-            progressbar.Percentage(),
-            progressbar.Bar(),
-        ]
+        self.setup(**options)
+
+        if options.get('delta', False):
+            self.delta_import(options.get('delta_since', None))
+            self.search_names_update()
+            self.data_changed()
+            return
 
-        for url in SOURCES:
+        def download(url):
             destination_file_name = url.split('/')[-1]
 
             force = options.get('force_all', False)
@@ -107,7 +153,14 @@ It is possible to force the import of files which weren't downloaded using the
                     if f in destination_file_name or f in url:
                         force = True
 
-            geonames = Geonames(url, force=force)
+            return Geonames(url, force=force, extract=self.extract)
+
+        # download and extract all sources concurrently, import them in order
+        # as soon as they are ready
+        downloads = self.prefetch(SOURCES, download)
+
+        for url, geonames in downloads:
+            destination_file_name = url.split('/')[-1]
             downloaded = geonames.downloaded
 
             force_import = options.get('force_import_all', False)
@@ -117,91 +170,243 @@ It is possible to force the import of files which weren't downloaded using the
                     if f in destination_file_name or f in url:
                         force_import = True
 
+            if url in TRANSLATION_SOURCES and options.get(
+                    'hack_translations', False):
+                if translation_cache.is_valid(geonames.file_path,
+                        TRANSLATION_LANGUAGES):
+                    self.logger.debug('Using translation parsed data: %s' %
+                        translation_cache.path)
+                    translation_cache_source = geonames.file_path
+                    continue
+
             if downloaded or force_import:
                 self.logger.info('Importing %s' % destination_file_name)
 
-                if url in TRANSLATION_SOURCES:
-                    if options.get('hack_translations', False):
-                        if os.path.exists(translation_hack_path):
-                            self.logger.debug(
-                                'Using translation parsed data: %s' %
-                                translation_hack_path)
-                            continue
-
-                i = 0
-                progress = progressbar.ProgressBar(maxval=geonames.num_lines(),
+                if url in CITY_SOURCES or url in REGION_SOURCES:
+                    self.fingerprints = Fingerprints(os.path.join(DATA_DIR,
+                        destination_file_name + '.fingerprints')).load()
+                    self.skipped = 0
+
+                progress = progressbar.ProgressBar(maxval=geonames.size(),
                     widgets=self.widgets)
 
-                for items in geonames.parse():
-                    if url in CITY_SOURCES:
-                        self.city_import(items)
-                    elif url in REGION_SOURCES:
-                        self.region_import(items)
-                    elif url in COUNTRY_SOURCES:
-                        self.country_import(items)
-                    elif url in TRANSLATION_SOURCES:
-                        # free some memory
-                        if getattr(self, '_country_codes', False):
-                            del self._country_codes
-                        if getattr(self, '_region_codes', False):
-                            del self._region_codes
-                        self.translation_parse(items)
-
-                    reset_queries()
-
-                    i += 1
-                    progress.update(i)
+                # only alternate names are worth parsing in workers, which
+                # drop most of their rows: pickling back all the rows of the
+                # other files costs about as much as parsing them here
+                workers = 1
+                row_filter = None
+                if url in TRANSLATION_SOURCES:
+                    workers = self.workers
+                    row_filter = AlternateNamesFilter(TRANSLATION_LANGUAGES)
+
+                try:
+                    for row in self.source_import(url, destination_file_name,
+                            geonames.parse(workers=workers,
+                            row_filter=row_filter)):
+                        progress.update(geonames.position)
+                except Exception:
+                    downloads.close()
+                    raise
 
                 progress.finish()
 
+                if self.fingerprints is not None:
+                    self.fingerprints.save()
+                    counts = self.fingerprints.counts
+                    self.logger.info(
+                        '%s: %s new, %s changed, %s skipped rows' % (
+                            destination_file_name,
+                            counts[Fingerprints.NEW],
+                            counts[Fingerprints.CHANGED],
+                            self.skipped))
+                    self.fingerprints = None
+
                 if url in TRANSLATION_SOURCES and options.get(
                         'hack_translations', False):
-                    with open(translation_hack_path, 'w+') as f:
-                        pickle.dump(self.translation_data, f)
+                    translation_cache.write(self.translation_data,
+                        geonames.file_path, TRANSLATION_LANGUAGES)
+                    translation_cache_source = geonames.file_path
 
-        if options.get('hack_translations', False):
-            with open(translation_hack_path, 'r') as f:
-                self.translation_data = pickle.load(f)
+        if translation_cache_source:
+            if hasattr(self, 'translation_data'):
+                self.translation_data.close()
+            self.translation_data = translation_cache.open()
 
         self.logger.info('Importing parsed translation in the database')
         self.translation_import()
+        self.search_names_update()
 
-    def _get_country_id(self, code2):
+        if hasattr(self, 'translation_data'):
+            self.translation_data.close()
+
+        self.data_changed()
+
+    def prefetch(self, urls, download):
         '''
-        Simple lazy identity map for code2->country
+        Yield (url, download(url)) for each url, in order, while the next
+        urls are downloaded by download_workers threads.
+
+        If download fails, or the generator is closed before the end, the
+        pending downloads are cancelled.
         '''
-        if not hasattr(self, '_country_codes'):
-            self._country_codes = {}
+        pool = ThreadPool(self.download_workers)
+        results = [pool.apply_async(download, (url, )) for url in urls]
+        pool.close()
 
-        if code2 not in self._country_codes.keys():
-            self._country_codes[code2] = Country.objects.get(code2=code2).pk
+        try:
+            for url, result in zip(urls, results):
+                yield url, result.get()
+        except BaseException:
+            pool.terminate()
+            raise
+
+        pool.join()
 
-        return self._country_codes[code2]
+    def data_changed(self):
+        '''
+        Tell processes using cities_light.autocomplete that the data
+        changed, rebuild the prebuilt index file if there is one.
+        '''
+        if os.path.exists(INDEX_PATH):
+            self.logger.info('Rebuilding autocomplete index %s' % INDEX_PATH)
+            CityIndex.build().save(INDEX_PATH)
+
+        data_changed()
+
+    def setup(self, **options):
+        '''
+        Set the import options and load the index of existing rows.
+        '''
+        self.noinsert = options.get('noinsert', False)
+        self.force_all = options.get('force_all', False)
+        self.send_signals = not options.get('no_signals', False)
+        self.fingerprints = None
+        self.skipped = 0
+        self.batch_size = options.get('batch_size') or IMPORT_BATCH_SIZE
+        self.transaction_size = options.get('transaction_size') or \
+            IMPORT_TRANSACTION_SIZE
+        self.translation_memory_limit = options.get(
+            'translation_memory_limit') or TRANSLATION_MEMORY_LIMIT
+        self.workers = options.get('workers') or 1
+        self.download_workers = options.get('download_workers') or 1
+        self.extract = EXTRACT_SOURCES and not options.get('no_extract',
+            False)
+
+        self.logger.info('Loading index of existing countries, regions and '
+            'cities')
+        self.index = ImportIndex().load()
+        self._city_batch = []
+
+        # pks of the rows whose names changed without sending pre_save to
+        # their cities, see search_names_update()
+        self.renamed = {Country: set(), Region: set(), City: set()}
+        self.widgets = [
+            'RAM used: ',
+            MemoryUsageWidget(),
+            ' ',
+            progressbar.ETA(),
+            ' Done: ',
+            progressbar.Percentage(),
+            progressbar.Bar(),
+        ]
+
+    def source_import(self, url, file_name, rows):
+        '''
+        Import the parsed rows of the source url, in transactions of
+        transaction_size rows, and yield the number of rows imported after
+        each transaction.
+
+        A failed transaction is rolled back and reported, then the error is
+        raised: the rows of the previous transactions stay committed.
+        '''
+        row = 0
+        for batch in self.transaction_batches(rows):
+            try:
+                with transaction.atomic():
+                    for items in batch:
+                        if url in CITY_SOURCES:
+                            self.city_import(items)
+                        elif url in REGION_SOURCES:
+                            self.region_import(items)
+                        elif url in COUNTRY_SOURCES:
+                            self.country_import(items)
+                        elif url in TRANSLATION_SOURCES:
+                            self.translation_parse(items)
+
+                        reset_queries()
+
+                    if url in CITY_SOURCES:
+                        self.city_flush()
+            except Exception:
+                self.logger.error('Rolled back rows %s to %s of %s' % (
+                    row + 1, row + len(batch), file_name))
+                raise
+
+            row += len(batch)
+            yield row
+
+    def transaction_batches(self, rows):
+        '''
+        Yield lists of transaction_size rows, each imported in its own
+        transaction.
+        '''
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.transaction_size))
+            if not batch:
+                return
+            yield batch
+
+    def _get_country_id(self, code2):
+        '''
+        code2 -> country pk, raise Country.DoesNotExist if unknown.
+        '''
+        return self.index.country_id(code2)
 
     def _get_region_id(self, country_code2, region_id):
         '''
-        Simple lazy identity map for (country_code2, region_id)->region
+        (country_code2, region_id) -> region pk, raise Region.DoesNotExist if
+        unknown.
         '''
-        if not hasattr(self, '_region_codes'):
-            self._region_codes = {}
+        return self.index.region_id(country_code2, region_id)
 
-        country_id = self._get_country_id(country_code2)
-        if country_id not in self._region_codes:
-            self._region_codes[country_id] = {}
+    def _unchanged(self, geoname_id, items, index, **foreign_keys):
+        '''
+        Record the fingerprint of a row, return True if it can be skipped:
+        it did not change since the previous import, is in the database and
+        its foreign_keys, resolved from the row, are the stored ones. A city
+        imported before its region exists gets it on the next import.
+        --force-all disables skipping.
+        '''
+        if self.fingerprints is None:
+            return False
+
+        status = self.fingerprints.check(geoname_id, items)
+        if status != Fingerprints.UNCHANGED or self.force_all:
+            return False
+
+        pk = index.get('geoname_id', geoname_id)
+        if pk is None:
+            return False
 
-        if region_id not in self._region_codes[country_id]:
-            self._region_codes[country_id][region_id] = Region.objects.get(
-                country_id=country_id, geoname_code=region_id).pk
+        for field, value in foreign_keys.items():
+            if index.value(pk, field) != value:
+                return False
 
-        return self._region_codes[country_id][region_id]
+        self.skipped += 1
+        return True
 
     def country_import(self, items):
-        try:
-            country = Country.objects.get(code2=items[0])
-        except Country.DoesNotExist:
+        pk = self.index.countries.get('code2', items[0])
+        if pk is None:
             if self.noinsert:
                 return
             country = Country(code2=items[0])
+        else:
+            country = Country.objects.get(pk=pk)
+
+        if country.pk and country.name != force_unicode(items[4]):
+            self.renamed[Country].add(country.pk)
 
         country.name = force_unicode(items[4])
         country.code3 = items[1]
@@ -210,6 +415,7 @@ It is possible to force the import of files which weren't downloaded using the
         if items[16]:
             country.geoname_id = items[16]
         country.save()
+        self.index.countries.add_instance(country)
 
     def region_import(self, items):
         try:
@@ -217,34 +423,34 @@ It is possible to force the import of files which weren't downloaded using the
         except InvalidItems:
             return
 
+        code2, geoname_code = items[0].split('.')
+
+        country_id = self._get_country_id(code2)
+
+        if items[3] and self._unchanged(int(items[3]), items,
+                self.index.regions, country_id=country_id):
+            return
+
         items = [force_unicode(x) for x in items]
+        geoname_code = force_unicode(geoname_code)
 
         name = items[1]
         if not items[1]:
             name = items[2]
 
-        code2, geoname_code = items[0].split('.')
-
-        country_id = self._get_country_id(code2)
-
         if items[3]:
             kwargs = dict(geoname_id=items[3])
+            pk = self.index.regions.get('geoname_id', int(items[3]))
         else:
-            try:
-                kwargs = dict(name=name,
-                    country_id=country_id)
-            except Country.DoesNotExist:
-                if self.noinsert:
-                    return
-                else:
-                    raise
+            kwargs = dict(name=name, country_id=country_id)
+            pk = self.index.regions.get('name', (country_id, name))
 
-        try:
-            region = Region.objects.get(**kwargs)
-        except Region.DoesNotExist:
+        if pk is None:
             if self.noinsert:
                 return
             region = Region(**kwargs)
+        else:
+            region = Region.objects.get(pk=pk)
 
         if not region.name:
             region.name = name
@@ -260,6 +466,7 @@ It is possible to force the import of files which weren't downloaded using the
 
         region.geoname_id = items[3]
         region.save()
+        self.index.regions.add_instance(region)
 
     def city_import(self, items):
         try:
@@ -275,38 +482,124 @@ It is possible to force the import of files which weren't downloaded using the
             else:
                 raise
 
-        kwargs = dict(name=force_unicode(items[1]),
-                country_id=self._get_country_id(items[8]))
-
-
         try:
-            kwargs = dict(name=force_unicode(items[1]),
-                region_id=self._get_region_id(items[8], items[10]),
-                country_id=self._get_country_id(items[8]))
-        except Country.DoesNotExist:
-            if self.noinsert:
-                return
-            else:
-                raise
+            region_id = self._get_region_id(items[8], items[10])
         except Region.DoesNotExist:
-            if self.noinsert:
-                return
-            else:
-                pass
+            region_id = None
 
-        try:
-            city = City.objects.get(geoname_id=items[0])
-        except City.DoesNotExist:
-            cities = City.objects.filter(**kwargs)
-            if cities:
-                city = cities[0]
-            elif self.noinsert:
-                    return
+        if self._unchanged(int(items[0]), items, self.index.cities,
+                country_id=country_id, region_id=region_id):
+            return
+
+        if region_id is None and self.noinsert:
+            return
+
+        self._city_batch.append((items, country_id, region_id))
+
+        if len(self._city_batch) >= self.batch_size:
+            self.city_flush()
+
+    def city_flush(self):
+        '''
+        Resolve and write the buffered city rows.
+
+        Existing cities are matched against the import index, by geoname_id
+        first and then by (name, region, country), and fetched with a single
+        in_bulk() query. New cities are inserted with bulk_create() and
+        changed ones are written back with bulk_update().
+        '''
+        batch = getattr(self, '_city_batch', None)
+        if not batch:
+            return
+        self._city_batch = []
+
+        index = self.index.cities
+        rows = []
+        for items, country_id, region_id in batch:
+            name = force_unicode(items[1])
+
+            pk = index.get('geoname_id', int(items[0]))
+            if pk is None and region_id is None:
+                pk = index.get('country_name', (name, country_id))
+            elif pk is None:
+                pk = index.get('name', (name, country_id, region_id))
+
+            rows.append((items, name, country_id, region_id, pk))
+
+        existing = City.objects.in_bulk(
+            set(row[4] for row in rows if row[4] is not None))
+
+        # cities created or matched earlier in this batch, by index key
+        pending = {}
+        created = []
+        updated = {}
+        for items, name, country_id, region_id, pk in rows:
+            if region_id is None:
+                fallback = ('country_name', (name, country_id))
             else:
-                city = City(**kwargs)
+                fallback = ('name', (name, country_id, region_id))
+
+            city = pending.get(('geoname_id', int(items[0])), None)
+            if city is None:
+                city = existing.get(pk, None)
+            if city is None:
+                city = pending.get(fallback, None)
 
+            if city is None:
+                if self.noinsert:
+                    continue
+
+                city = City(name=name, country_id=country_id,
+                    region_id=region_id)
+                created.append(city)
+                pending[fallback] = city
+
+                if region_id is not None:
+                    pending.setdefault(
+                        ('country_name', (name, country_id)), city)
 
+            if self._city_fill(city, items) and city.pk:
+                updated[city.pk] = city
 
+            if city.geoname_id:
+                pending[('geoname_id', int(city.geoname_id))] = city
+
+        self._city_prepare(created + list(updated.values()))
+
+        if created:
+            try:
+                with transaction.atomic():
+                    City.objects.bulk_create(created)
+            except Exception:
+                # some row conflicts with an existing record, find it
+                for city in created:
+                    if self._city_save(city):
+                        index.add_instance(city)
+            else:
+                # bulk_create() does not set pks on every backend
+                fields = ['pk', 'geoname_id', 'name', 'country_id',
+                    'region_id']
+                for row in City.objects.filter(geoname_id__in=[
+                        int(c.geoname_id) for c in created]).values_list(
+                        *fields):
+                    index.add(row[0], **dict(zip(fields[1:], row[1:])))
+
+        if updated:
+            bulk_update(City, updated.values(), self.city_update_fields)
+
+            for city in updated.values():
+                index.add_instance(city)
+
+    city_update_fields = ['region', 'name_ascii', 'display_name', 'latitude',
+        'longitude', 'alternate_names', 'geoname_id', 'population',
+        'feature_class', 'feature_code', 'search_names', 'scaled_latitude',
+        'scaled_longitude']
+
+    def _city_fill(self, city, items):
+        '''
+        Fill the blanks of a city with a parsed row, return True if anything
+        changed.
+        '''
         save = False
         if not city.region_id:
             try:
@@ -351,53 +644,90 @@ It is possible to force the import of files which weren't downloaded using the
             city.feature_code = items[7]
             save = True
 
-        if save:
-            try:
+        return save
+
+    def _city_prepare(self, cities):
+        '''
+        Set the fields that pre_save handlers would set on cities which are
+        about to be written in bulk.
+
+        By default, pre_save is sent with the region and country of the
+        cities fetched in one query each, rather than once per city by
+        get_display_name(). With --no-signals, city_country,
+        set_name_ascii, set_display_name, city_search_names and
+        set_scaled_coordinates are called directly, with region and country
+        names from the import index: no query at all, and receivers
+        connected by other apps are not called. The slug is set by
+        AutoSlugField.pre_save() within bulk_create() in both cases.
+        '''
+        if not self.send_signals:
+            return self._city_denormalize(cities)
+
+        regions = Region.objects.in_bulk(
+            set(c.region_id for c in cities if c.region_id))
+        countries = Country.objects.in_bulk(
+            set(c.country_id for c in cities))
+
+        using = router.db_for_write(City)
+        for city in cities:
+            if city.region_id in regions:
+                city.region = regions[city.region_id]
+            if city.country_id in countries:
+                city.country = countries[city.country_id]
+
+            signals.pre_save.send(sender=City, instance=city, raw=False,
+                using=using, update_fields=None)
+
+    def _city_denormalize(self, cities):
+        regions = self.index.regions
+        countries = self.index.countries
+
+        for city in cities:
+            if city.region_id:
+                country_id = regions.value(city.region_id, 'country_id')
+                city.region = Region(pk=city.region_id, country_id=country_id,
+                    name=regions.value(city.region_id, 'name'),
+                    alternate_names=regions.value(city.region_id,
+                        'alternate_names'))
+                city.region.country = Country(pk=country_id)
+
+            city_country(City, city)
+
+            city.country = Country(pk=city.country_id,
+                name=countries.value(city.country_id, 'name'),
+                alternate_names=countries.value(city.country_id,
+                    'alternate_names'))
+
+            set_name_ascii(City, city)
+            set_display_name(City, city)
+            city_search_names(City, city)
+            set_scaled_coordinates(City, city)
+
+    def _city_save(self, city):
+        try:
+            with transaction.atomic():
                 city.save()
-            except Exception as e:
-                # swallow this exception silently.
-                self.logger.debug('problably because record already exists: trouble saving city %s %s %s %s %s: %s' % (city.name, city.region, city.country, city.feature_class, city.feature_code, e))
+            return True
+        except Exception as e:
+            # swallow this exception silently.
+            self.logger.debug('problably because record already exists: trouble saving city %s %s %s %s %s: %s' % (city.name, city.region, city.country, city.feature_class, city.feature_code, e))
 
     def translation_parse(self, items):
+        '''
+        Buffer an alternate name, from a row filtered and converted by
+        AlternateNamesFilter while parsing.
+        '''
         if not hasattr(self, 'translation_data'):
-            self.country_ids = Country.objects.values_list('geoname_id',
-                flat=True)
-            self.region_ids = Region.objects.values_list('geoname_id',
-                flat=True)
-            self.city_ids = City.objects.values_list('geoname_id', flat=True)
-
-            self.translation_data = {
-                Country: {},
-                Region: {},
-                City: {},
-            }
-
-        if len(items) > 4:
-            # avoid shortnames, colloquial, and historic
-            return
+            self.geoname_models = self.index.geoname_models()
 
-        if items[2] not in TRANSLATION_LANGUAGES:
-            return
-
-        # arg optimisation code kills me !!!
-        items[1] = int(items[1])
+            self.translation_data = TranslationBuffer(
+                self.translation_memory_limit)
 
-        if items[1] in self.country_ids:
-            model_class = Country
-        elif items[1] in self.region_ids:
-            model_class = Region
-        elif items[1] in self.city_ids:
-            model_class = City
-        else:
+        model_class = self.geoname_models.get(items[1], None)
+        if model_class is None:
             return
 
-        if items[1] not in self.translation_data[model_class]:
-            self.translation_data[model_class][items[1]] = {}
-
-        if items[2] not in self.translation_data[model_class][items[1]]:
-            self.translation_data[model_class][items[1]][items[2]] = []
-
-        self.translation_data[model_class][items[1]][items[2]].append(items[3])
+        self.translation_data.add(model_class, items[1], items[2], items[3])
 
     def translation_import(self):
         data = getattr(self, 'translation_data', None)
@@ -405,46 +735,298 @@ It is possible to force the import of files which weren't downloaded using the
         if not data:
             return
 
-        max = 0
-        for model_class, model_class_data in data.items():
-            max += len(model_class_data.keys())
-
         i = 0
-        progress = progressbar.ProgressBar(maxval=max, widgets=self.widgets)
-        for model_class, model_class_data in data.items():
-            for geoname_id, geoname_data in model_class_data.items():
-                try:
-                    model = model_class.objects.get(geoname_id=geoname_id)
-                except model_class.DoesNotExist:
+        progress = progressbar.ProgressBar(maxval=len(data),
+            widgets=self.widgets)
+        indexes = {
+            Country: self.index.countries,
+            Region: self.index.regions,
+            City: self.index.cities,
+        }
+        writers = dict((model_class, AlternateNamesWriter(model_class,
+            self.batch_size)) for model_class in indexes.keys())
+
+        for model_class, geoname_id, geoname_data in data:
+            i += sum(len(names) for names in geoname_data.values())
+            progress.update(i)
+
+            pk = indexes[model_class].get('geoname_id', geoname_id)
+            if pk is None:
+                continue
+
+            names = []
+            for lang, lang_names in geoname_data.items():
+                if lang == 'post':
+                    # we might want to save the postal codes somewhere
+                    # here's where it will all start ...
                     continue
-                save = False
 
-                if not model.alternate_names:
-                    alternate_names = []
+                names.extend(force_unicode(name) for name in lang_names)
+
+            if names:
+                writers[model_class].add(pk, names)
+
+        for model_class, writer in writers.items():
+            writer.flush()
+            self.renamed[model_class].update(writer.changed)
+            self.logger.info('Updated alternate_names of %s %s' % (
+                writer.updated, model_class._meta.verbose_name_plural))
+
+        progress.finish()
+
+    def search_names_update(self):
+        '''
+        Rebuild search_names of the cities whose names, or the names of
+        their region or country, changed in this run without sending
+        pre_save to the city: alternate names imports, renamed countries and
+        regions, cities which lost their region.
+
+        Cities are rebuilt with update_search_names() by batch_size pks of
+        cities, regions or countries. The search index of the database
+        follows through its triggers, if any.
+        '''
+        if not any(self.renamed.values()):
+            return
+
+        region_names = names_by_pk(Region.objects.all())
+        country_names = names_by_pk(Country.objects.all())
+
+        lookups = [('pk__in', self.renamed[City]),
+            ('region_id__in', self.renamed[Region]),
+            ('country_id__in', self.renamed[Country])]
+
+        updated = 0
+        for lookup, pks in lookups:
+            pks = sorted(pks)
+
+            for start in range(0, len(pks), self.batch_size):
+                cities = City.objects.filter(**{
+                    lookup: pks[start:start + self.batch_size]})
+
+                with transaction.atomic():
+                    updated += update_search_names(cities, region_names,
+                        country_names)
+
+        self.renamed = {Country: set(), Region: set(), City: set()}
+        self.logger.info('Updated search_names of %s cities' % updated)
+
+    # daily files applied by delta_import(), in order
+    delta_kinds = ['modifications', 'deletes', 'alternateNamesModifications',
+        'alternateNamesDeletes']
+
+    def delta_import(self, since=None):
+        '''
+        Apply the GeoNames daily files of each day after the last one
+        applied, up to yesterday, then record it in DATA_DIR/delta_last_date.
+
+        If no day was applied yet, start at since (YYYY-MM-DD) or yesterday.
+        Days older than DELTA_RETENTION_DAYS are not published anymore and
+        are skipped.
+        '''
+        last_date = self.delta_last_date()
+        today = datetime.date.today()
+        yesterday = today - datetime.timedelta(days=1)
+
+        if last_date:
+            day = last_date + datetime.timedelta(days=1)
+        elif since:
+            day = datetime.datetime.strptime(since, '%Y-%m-%d').date()
+        else:
+            day = yesterday
+
+        first_day = today - datetime.timedelta(days=DELTA_RETENTION_DAYS)
+        if day < first_day:
+            self.logger.warning('Skipping changes of %s to %s, which are not '
+                'published anymore, run a full import to catch up' % (day,
+                first_day - datetime.timedelta(days=1)))
+            day = first_day
+
+        while day <= yesterday:
+            self.delta_day(day)
+            self.delta_save_date(day)
+            day += datetime.timedelta(days=1)
+
+    def delta_day(self, day):
+        '''
+        Download and apply the daily files of day, then remove them from
+        DATA_DIR.
+        '''
+        self.logger.info('Applying changes of %s' % day)
+
+        sources = [Geonames('%s%s-%s.txt' % (DELTA_URL, kind,
+            day.isoformat())) for kind in self.delta_kinds]
+
+        # a day is applied entirely or not at all
+        with transaction.atomic():
+            for kind, geonames in zip(self.delta_kinds, sources):
+                self.delta_apply(kind, geonames.parse())
+
+        for geonames in sources:
+            for path in (geonames.file_path, geonames.file_path + '.meta'):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def delta_last_date(self):
+        '''
+        Return the date of the last daily files applied, or None.
+        '''
+        path = os.path.join(DATA_DIR, 'delta_last_date')
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r') as f:
+            return datetime.datetime.strptime(f.read().strip(),
+                '%Y-%m-%d').date()
+
+    def delta_save_date(self, day):
+        with open(os.path.join(DATA_DIR, 'delta_last_date'), 'w') as f:
+            f.write(day.isoformat())
+
+    def delta_apply(self, kind, rows):
+        '''
+        Apply the rows of a daily file of the given kind.
+        '''
+        if kind == 'modifications':
+            for items in rows:
+                self.delta_modification(items)
+            self.city_flush()
+
+        elif kind == 'deletes':
+            for items in rows:
+                self.delta_delete(int(items[0]))
+
+        else:
+            geoname_indexes = (self.index.countries, self.index.regions,
+                self.index.cities)
+            writers = dict((index, AlternateNamesWriter(index.model,
+                self.batch_size)) for index in geoname_indexes)
+
+            for items in rows:
+                if kind == 'alternateNamesModifications':
+                    if len(items) > 4:
+                        # avoid shortnames, colloquial, and historic
+                        continue
+                    if items[2] not in TRANSLATION_LANGUAGES:
+                        continue
+                    if items[2] == 'post':
+                        continue
+                    name = items[3]
                 else:
-                    alternate_names = model.alternate_names.split(',')
+                    name = items[2]
 
-                for lang, names in geoname_data.items():
-                    if lang == 'post':
-                        # we might want to save the postal codes somewhere
-                        # here's where it will all start ...
+                for index in geoname_indexes:
+                    pk = index.get('geoname_id', int(items[1]))
+                    if pk is None:
                         continue
 
-                    for name in names:
-                        name = force_unicode(name)
-                        if name == model.name:
-                            continue
+                    if kind == 'alternateNamesModifications':
+                        writers[index].add(pk, [force_unicode(name)])
+                    else:
+                        writers[index].remove(pk, [force_unicode(name)])
+                    break
+
+            for index, writer in writers.items():
+                writer.flush()
+                self.renamed[index.model].update(writer.changed)
+
+    def delta_modification(self, items):
+        '''
+        Update a city or region from a row of a modifications file, insert
+        it if it is new and populated enough.
+        '''
+        geoname_id = int(items[0])
+
+        if items[7] == 'ADM1':
+            return self.delta_region(items)
+
+        pk = self.index.cities.get('geoname_id', geoname_id)
+        if pk is None:
+            if int(items[14] or 0) >= DELTA_MIN_POPULATION:
+                self.city_import(items)
+            return
+
+        try:
+            city_items_pre_import.send(sender=self, items=items)
+        except InvalidItems:
+            return
+
+        city = City.objects.get(pk=pk)
+        city.name = force_unicode(items[1])
+        city.name_ascii = items[2]
+        city.latitude = items[4]
+        city.longitude = items[5]
+        city.feature_class = items[6]
+        city.feature_code = items[7]
+        city.population = items[14]
+
+        try:
+            city.country_id = self._get_country_id(items[8])
+            city.region_id = self._get_region_id(items[8], items[10])
+        except (Country.DoesNotExist, Region.DoesNotExist):
+            pass
+
+        if self._city_save(city):
+            self.index.cities.add_instance(city)
+
+    def delta_region(self, items):
+        try:
+            region_items_pre_import.send(sender=self, items=[
+                '%s.%s' % (items[8], items[10]), items[1], items[2],
+                items[0]])
+        except InvalidItems:
+            return
+
+        pk = self.index.regions.get('geoname_id', int(items[0]))
+        if pk is None:
+            if self.noinsert:
+                return
+
+            try:
+                country_id = self._get_country_id(items[8])
+            except Country.DoesNotExist:
+                return
+
+            region = Region(geoname_id=items[0], country_id=country_id,
+                geoname_code=items[10])
+        else:
+            region = Region.objects.get(pk=pk)
 
-                        if name not in alternate_names:
-                            alternate_names.append(name)
+        if region.pk and region.name != force_unicode(items[1]):
+            self.renamed[Region].add(region.pk)
 
-                alternate_names = u','.join(alternate_names)
-                if model.alternate_names != alternate_names:
-                    model.alternate_names = alternate_names
-                    save = True
+        region.name = force_unicode(items[1])
+        region.name_ascii = items[2]
+        region.save()
+        self.index.regions.add_instance(region)
 
-                if save:
-                    model.save()
+    def delta_delete(self, geoname_id):
+        '''
+        Delete the city or region with geoname_id. Cities of a deleted region
+        are kept, without region.
 
-                i += 1
-                progress.update(i)
+        The deleted rows are discarded from every map of the index, so that
+        a row inserted later in the same run cannot be matched to them.
+        '''
+        cities = self.index.cities
+        fields = cities.fields()
+
+        deleted = City.objects.filter(geoname_id=geoname_id)
+        for row in deleted.values_list('pk', *fields):
+            cities.discard(row[0], **dict(zip(fields, row[1:])))
+        deleted.delete()
+
+        regions = Region.objects.filter(geoname_id=geoname_id)
+        region_fields = self.index.regions.fields()
+        for region in regions.values_list('pk', *region_fields):
+            orphans = City.objects.filter(region_id=region[0])
+            for row in orphans.values_list('pk', *fields):
+                values = dict(zip(fields, row[1:]))
+                cities.discard(row[0], **values)
+                values['region_id'] = None
+                cities.add(row[0], **values)
+                self.renamed[City].add(row[0])
+            orphans.update(region=None)
+
+            self.index.regions.discard(region[0],
+                **dict(zip(region_fields, region[1:])))
+        regions.delete()
@@ -0,0 +1,32 @@
+import os
+import os.path
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...autocomplete import CityIndex, INDEX_PATH
+from ...settings import *
+
+
+class Command(BaseCommand):
+    help = '''
+Build the autocomplete index of cities and save it into
+DATA_DIR/autocomplete.index, replacing the previous one atomically.
+
+Processes using cities_light.autocomplete memory-map this file instead of
+building the index themselves, and reopen it when it is replaced. Once it
+exists, the cities_light command rebuilds it after each import.
+    '''.strip()
+
+    logger = logging.getLogger('cities_light')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(DATA_DIR):
+            self.logger.info('Creating %s' % DATA_DIR)
+            os.mkdir(DATA_DIR)
+
+        self.logger.info('Building autocomplete index')
+        index = CityIndex.build()
+        index.save(INDEX_PATH)
+        self.logger.info('Saved %s cities and %s keys into %s' % (
+            len(index), len(index.keys), INDEX_PATH))
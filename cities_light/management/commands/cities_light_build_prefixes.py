@@ -0,0 +1,166 @@
+import os
+import os.path
+import logging
+import optparse
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...fingerprints import Fingerprints
+from ...models import City, City_Name_Prefix, Region, name_prefixes
+from ...settings import *
+
+
+class Command(BaseCommand):
+    help = '''
+Fill City_Name_Prefix and the City.autocomplete_prefixes relation for all
+cities, with bulk inserts.
+
+Prefixes are computed in memory like city_autocomplete_prefixes does, then
+missing prefixes and all relations are inserted in batches of --batch-size
+rows. Prefixes which are not used anymore are deleted.
+
+With --incremental, only the cities which were added, renamed or moved to
+another region since the previous build are processed:
+
+    manage.py cities_light_build_prefixes --incremental
+    '''.strip()
+
+    logger = logging.getLogger('cities_light')
+
+    option_list = BaseCommand.option_list + (
+        optparse.make_option('--incremental', action='store_true',
+            default=False,
+            help='Only process cities changed since the previous build'
+        ),
+        optparse.make_option('--batch-size', action='store', type='int',
+            default=10000,
+            help='Number of rows to buffer before each bulk insert'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if not os.path.exists(DATA_DIR):
+            self.logger.info('Creating %s' % DATA_DIR)
+            os.mkdir(DATA_DIR)
+
+        self.batch_size = options.get('batch_size') or 10000
+        self.fingerprints = Fingerprints(
+            os.path.join(DATA_DIR, 'prefixes.fingerprints'))
+
+        incremental = options.get('incremental', False)
+        if incremental and not os.path.exists(self.fingerprints.path):
+            self.logger.info('No previous build, building all prefixes')
+            incremental = False
+
+        if incremental:
+            self.fingerprints.load()
+
+        cities, prefixes = self.changed_cities()
+        self.logger.info('%s cities to process, %s prefixes' % (
+            len(cities), len(prefixes)))
+
+        with transaction.atomic():
+            prefix_ids = self.prefix_ids(prefixes)
+            relations = self.write_relations(cities, prefix_ids,
+                incremental)
+
+            if not incremental:
+                City_Name_Prefix.objects.filter(city=None).delete()
+
+        self.fingerprints.save()
+        self.logger.info('Inserted %s city prefix relations' % relations)
+
+    def changed_cities(self):
+        '''
+        Return the list of (pk, name, region name) of cities to process, and
+        the set of their prefixes.
+
+        Cities are streamed with a single query, those with the same name
+        and region as in the previous build are skipped. Cities which do not
+        exist anymore are removed from the fingerprints, their relations are
+        deleted in cascade by the database.
+        '''
+        regions = dict(Region.objects.values_list('pk', 'name'))
+
+        cities = []
+        prefixes = set()
+        seen = set()
+
+        rows = City.objects.order_by().values_list('pk', 'name',
+            'region_id')
+        for pk, name, region_id in rows.iterator():
+            seen.add(pk)
+            region_name = regions.get(region_id, None)
+
+            status = self.fingerprints.check(pk, [name, region_name or u''])
+            if status == Fingerprints.UNCHANGED:
+                continue
+
+            cities.append((pk, name, region_name))
+            prefixes.update(name_prefixes(name, region_name))
+
+        for pk in set(self.fingerprints.hashes.keys()) - seen:
+            del self.fingerprints.hashes[pk]
+
+        return cities, prefixes
+
+    def prefix_ids(self, prefixes):
+        '''
+        Return a dict of prefix -> City_Name_Prefix pk for prefixes,
+        inserting the missing ones in bulk.
+        '''
+        prefix_ids = self.load_prefix_ids(prefixes)
+
+        missing = [City_Name_Prefix(prefix=prefix)
+            for prefix in prefixes if prefix not in prefix_ids]
+        if missing:
+            self.logger.info('Inserting %s new prefixes' % len(missing))
+            for start in range(0, len(missing), self.batch_size):
+                City_Name_Prefix.objects.bulk_create(
+                    missing[start:start + self.batch_size])
+
+            # bulk_create() does not set pks on every backend
+            prefix_ids = self.load_prefix_ids(prefixes)
+
+        return prefix_ids
+
+    def load_prefix_ids(self, prefixes):
+        rows = City_Name_Prefix.objects.order_by().values_list('prefix',
+            'pk')
+        return dict((prefix, pk) for prefix, pk in rows.iterator()
+            if prefix in prefixes)
+
+    def write_relations(self, cities, prefix_ids, incremental):
+        '''
+        Replace the prefix relations of cities, return the number of
+        relations inserted.
+        '''
+        through = City.autocomplete_prefixes.through
+
+        if incremental:
+            # small chunks, SQLite limits queries to 999 parameters
+            pks = [city[0] for city in cities]
+            for start in range(0, len(pks), IMPORT_BATCH_SIZE):
+                through.objects.filter(
+                    city_id__in=pks[start:start + IMPORT_BATCH_SIZE]).delete()
+        else:
+            through.objects.all().delete()
+
+        relations = 0
+        batch = []
+        for pk, name, region_name in cities:
+            for prefix in name_prefixes(name, region_name):
+                batch.append(through(city_id=pk,
+                    city_name_prefix_id=prefix_ids[prefix]))
+
+            if len(batch) >= self.batch_size:
+                through.objects.bulk_create(batch)
+                relations += len(batch)
+                batch = []
+
+        if batch:
+            through.objects.bulk_create(batch)
+            relations += len(batch)
+
+        return relations
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import cities_light.models
+from cities_light.models import names_by_pk, update_search_names
+from cities_light.settings import INDEX_SEARCH_NAMES
+
+from cities_light.migrations._search_index import SQLITE_INDEX, SQLITE_DROP, sqlite_has_fts5
+
+BACKFILL_BATCH_SIZE = 500
+
+
+POSTGRESQL_INDEX = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    # icontains lookups compare UPPER(search_names::text)
+    'CREATE INDEX cities_light_city_search_names_trgm ON cities_light_city '
+    'USING gin ((UPPER("search_names"::text)) gin_trgm_ops)',
+]
+
+POSTGRESQL_DROP = [
+    'DROP INDEX IF EXISTS cities_light_city_search_names_trgm',
+]
+
+def statements(connection, create):
+    """
+    Return the SQL statements to create or drop the search_names index of
+    the database backend, if INDEX_SEARCH_NAMES is set. MySQL gets a
+    FULLTEXT index in migration 0004.
+    """
+    if not INDEX_SEARCH_NAMES:
+        return []
+
+    if connection.vendor == 'postgresql':
+        return POSTGRESQL_INDEX if create else POSTGRESQL_DROP
+    elif connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+        return SQLITE_INDEX if create else SQLITE_DROP
+    return []
+
+
+def fill_search_names(apps, schema_editor):
+    """
+    Set search_names of the existing cities, before the index is created.
+    """
+    using = schema_editor.connection.alias
+    City = apps.get_model('cities_light', 'City')
+    region_names = names_by_pk(
+        apps.get_model('cities_light', 'Region').objects.using(using))
+    country_names = names_by_pk(
+        apps.get_model('cities_light', 'Country').objects.using(using))
+
+    pks = list(City.objects.using(using).order_by('pk').values_list('pk',
+        flat=True))
+    for start in range(0, len(pks), BACKFILL_BATCH_SIZE):
+        update_search_names(City.objects.using(using).filter(
+            pk__in=pks[start:start + BACKFILL_BATCH_SIZE]), region_names,
+            country_names)
+
+
+def create_index(apps, schema_editor):
+    for statement in statements(schema_editor.connection, True):
+        schema_editor.execute(statement)
+
+
+def drop_index(apps, schema_editor):
+    for statement in statements(schema_editor.connection, False):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cities_light', '0002_nullable_manytomany'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='search_names',
+            field=cities_light.models.ToSearchTextField(blank=True, default='', max_length=4000),
+        ),
+        migrations.RunPython(fill_search_names, migrations.RunPython.noop),
+        migrations.RunPython(create_index, drop_index),
+    ]
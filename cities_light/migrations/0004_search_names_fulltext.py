@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from cities_light.settings import INDEX_SEARCH_NAMES
+
+
+def create_index(apps, schema_editor):
+    # used by cities_light.search.MySQLSearchBackend
+    if INDEX_SEARCH_NAMES and schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('CREATE FULLTEXT INDEX '
+            'cities_light_city_search_names_fulltext ON cities_light_city '
+            '(search_names)')
+
+
+def drop_index(apps, schema_editor):
+    if INDEX_SEARCH_NAMES and schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('DROP INDEX '
+            'cities_light_city_search_names_fulltext ON cities_light_city')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cities_light', '0003_search_names'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Func
+
+from cities_light.migrations._search_index import sqlite_sync
+
+
+def scaled(field):
+    return Func(F(field) * 100000, function='ROUND',
+        output_field=models.IntegerField())
+
+
+def fill_scaled_coordinates(apps, schema_editor):
+    City = apps.get_model('cities_light', 'City')
+    City.objects.using(schema_editor.connection.alias).update(
+        scaled_latitude=scaled('latitude'),
+        scaled_longitude=scaled('longitude'))
+
+    if schema_editor.connection.vendor == 'sqlite':
+        # adding columns rebuilt cities_light_city without the triggers of
+        # the search table
+        sqlite_sync(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cities_light', '0004_search_names_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='scaled_latitude',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='scaled_longitude',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='city',
+            index_together=set([('scaled_latitude', 'scaled_longitude')]),
+        ),
+        migrations.RunPython(fill_scaled_coordinates,
+            migrations.RunPython.noop),
+    ]
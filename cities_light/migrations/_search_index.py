@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+DDL of the cities_light_city_search FTS5 table, which indexes
+City.search_names on SQLite, shared by the migrations and
+cities_light.search.
+
+This module is frozen like a migration: it must not import the models or
+the rest of cities_light, and the SQL must not change once released. A new
+version of the index goes in a new migration with its own DDL.
+
+SQLite rebuilds cities_light_city to alter most of its columns, which drops
+the triggers of the search table. Any migration which changes the schema of
+City must then call sqlite_sync() on SQLite, as 0005 does, after its schema
+operations.
+"""
+from __future__ import unicode_literals
+
+SQLITE_TABLE = 'cities_light_city_search'
+
+SQLITE_CREATE_TABLE = (
+    'CREATE VIRTUAL TABLE cities_light_city_search USING fts5('
+    'search_names, content=\'cities_light_city\', content_rowid=\'id\')')
+
+SQLITE_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS cities_light_city_search_insert AFTER '
+    'INSERT ON cities_light_city BEGIN INSERT INTO '
+    'cities_light_city_search(rowid, search_names) VALUES (new.id, '
+    'new.search_names); END',
+    'CREATE TRIGGER IF NOT EXISTS cities_light_city_search_delete AFTER '
+    'DELETE ON cities_light_city BEGIN INSERT INTO '
+    'cities_light_city_search(cities_light_city_search, rowid, '
+    'search_names) VALUES (\'delete\', old.id, old.search_names); END',
+    'CREATE TRIGGER IF NOT EXISTS cities_light_city_search_update AFTER '
+    'UPDATE OF search_names ON cities_light_city BEGIN INSERT INTO '
+    'cities_light_city_search(cities_light_city_search, rowid, '
+    'search_names) VALUES (\'delete\', old.id, old.search_names); '
+    'INSERT INTO cities_light_city_search(rowid, search_names) VALUES '
+    '(new.id, new.search_names); END',
+]
+
+SQLITE_REBUILD = (
+    'INSERT INTO cities_light_city_search(cities_light_city_search) '
+    'VALUES (\'rebuild\')')
+
+SQLITE_INDEX = [SQLITE_CREATE_TABLE] + SQLITE_TRIGGERS + [SQLITE_REBUILD]
+
+SQLITE_DROP = [
+    'DROP TRIGGER IF EXISTS cities_light_city_search_insert',
+    'DROP TRIGGER IF EXISTS cities_light_city_search_delete',
+    'DROP TRIGGER IF EXISTS cities_light_city_search_update',
+    'DROP TABLE IF EXISTS cities_light_city_search',
+]
+
+
+def sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return 'ENABLE_FTS5' in [row[0] for row in cursor.fetchall()]
+
+
+def sqlite_sync(connection):
+    """
+    Recreate the triggers of the search table, if it exists, and rebuild it
+    from search_names.
+    """
+    if SQLITE_TABLE not in connection.introspection.table_names():
+        return
+
+    with connection.cursor() as cursor:
+        for statement in SQLITE_TRIGGERS + [SQLITE_REBUILD]:
+            cursor.execute(statement)
@@ -1,17 +1,26 @@
+import math
 import unicodedata
 import re
+import threading
+from decimal import Decimal
 
 from django.utils.encoding import force_unicode
 from django.db.models import signals
-from django.db import models
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Concat
+from django.db import connection, models, transaction
 from django.utils.translation import ugettext as _
 
 import autoslug
 
+from .bulk import bulk_update
+
 from settings import *
 
 __all__ = ['Country', 'Region', 'City', 'CONTINENT_CHOICES', 'to_search',
-    'to_ascii']
+    'to_ascii', 'update_country_display_names',
+    'update_region_display_names', 'CityQuerySet', 'EARTH_RADIUS_KM',
+    'haversine']
 
 ALPHA_REGEXP = re.compile('[\W_]+', re.UNICODE)
 
@@ -140,6 +149,99 @@ class ToSearchTextField(models.TextField):
         return to_search(value)
 
 
+# mean radius
+EARTH_RADIUS_KM = 6371.0088
+
+# City.latitude and longitude have 5 decimal places
+COORDINATE_SCALE = 100000
+
+
+def scale_coordinate(value):
+    """
+    Return a latitude or longitude as an integer number of 1/COORDINATE_SCALE
+    degrees, or None.
+    """
+    if value is None or value == '':
+        return None
+    return int(round(Decimal(str(value)) * COORDINATE_SCALE))
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """
+    Return the great circle distance in km between two positions in
+    degrees.
+    """
+    latitude1, longitude1, latitude2, longitude2 = [math.radians(float(v))
+        for v in (latitude1, longitude1, latitude2, longitude2)]
+
+    a = math.sin((latitude2 - latitude1) / 2) ** 2 + math.cos(latitude1) * \
+        math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(math.sqrt(a), 1.0))
+
+
+class CityQuerySet(models.QuerySet):
+    """
+    QuerySet of City with geographic filters, which prune rows with the
+    index on scaled_latitude and scaled_longitude.
+    """
+
+    def in_bbox(self, south, west, north, east):
+        """
+        Return the cities in a bounding box, in degrees, most populated
+        first. A box with west greater than east crosses the antimeridian.
+        """
+        queryset = self.filter(scaled_latitude__gte=scale_coordinate(south),
+            scaled_latitude__lte=scale_coordinate(north))
+
+        if west <= east:
+            queryset = queryset.filter(
+                scaled_longitude__gte=scale_coordinate(west),
+                scaled_longitude__lte=scale_coordinate(east))
+        else:
+            queryset = queryset.filter(
+                models.Q(scaled_longitude__gte=scale_coordinate(west)) |
+                models.Q(scaled_longitude__lte=scale_coordinate(east)))
+
+        return queryset.order_by('-population')
+
+    def within_radius(self, latitude, longitude, radius_km):
+        """
+        Return the list of cities within radius_km of a position, most
+        populated first, each with its distance in km as a distance
+        attribute.
+
+        Candidates are the cities in the bounding box of the circle, found
+        with in_bbox(), the exact haversine distance is only computed for
+        them.
+        """
+        latitude, longitude = float(latitude), float(longitude)
+        angle = math.degrees(radius_km / EARTH_RADIUS_KM)
+        south, north = latitude - angle, latitude + angle
+        west, east = -180, 180
+
+        if south > -90 and north < 90:
+            # largest longitude difference in the circle
+            sin_angle = math.sin(math.radians(angle)) / math.cos(
+                math.radians(latitude))
+            if sin_angle < 1:
+                spread = math.degrees(math.asin(sin_angle))
+                west, east = longitude - spread, longitude + spread
+                if west < -180:
+                    west += 360
+                if east > 180:
+                    east -= 360
+
+        candidates = self.in_bbox(max(south, -90), west, min(north, 90), east)
+
+        cities = []
+        for city in candidates:
+            city.distance = haversine(latitude, longitude, city.latitude,
+                city.longitude)
+            if city.distance <= radius_km:
+                cities.append(city)
+        return cities
+
+
 class City_Name_Prefix(models.Model):
     prefix = models.CharField(max_length=200, db_index=True, unique=True)
 
@@ -152,13 +254,20 @@ class City(Base):
     name = models.CharField(max_length=200, db_index=True)
     display_name = models.CharField(max_length=200)
 
-#    search_names = ToSearchTextField(max_length=4000,
-#        db_index=INDEX_SEARCH_NAMES, blank=True, default='')
+    # indexed by migration 0003 depending on the database backend
+    search_names = ToSearchTextField(max_length=4000, blank=True,
+        default='')
 
     latitude = models.DecimalField(max_digits=8, decimal_places=5,
         null=True, blank=True)
     longitude = models.DecimalField(max_digits=8, decimal_places=5,
         null=True, blank=True)
+    # latitude and longitude * COORDINATE_SCALE, indexed together for
+    # CityQuerySet.in_bbox() and within_radius()
+    scaled_latitude = models.IntegerField(null=True, blank=True,
+        editable=False)
+    scaled_longitude = models.IntegerField(null=True, blank=True,
+        editable=False)
     population = models.BigIntegerField(null=True, blank=True, db_index=True)
     feature_class = models.CharField(max_length=1, null=True, blank=True, db_index=True)
     feature_code = models.CharField(max_length=10, null=True, blank=True, db_index=True)
@@ -167,11 +276,16 @@ class City(Base):
     region = models.ForeignKey(Region, blank=True, null=True, db_index=True)
     country = models.ForeignKey(Country, db_index=True)
 
+    objects = CityQuerySet.as_manager()
+
     class Meta:
         unique_together = (
             ('country', 'region', 'name', 'feature_class', 'feature_code', 'population'),
             ('country', 'region', 'name', 'feature_class', 'feature_code'),
             )
+        index_together = (
+            ('scaled_latitude', 'scaled_longitude'),
+            )
         verbose_name_plural = _(u'cities')
 
     def get_display_name(self):
@@ -198,66 +312,273 @@ class City(Base):
         powerset = self.powerset(city_tokens + region_tokens + country_tokens)
         return ' '.join(powerset)
 
-signals.pre_save.connect(set_name_ascii, sender=City)
-signals.pre_save.connect(set_display_name, sender=City)
-
 
 def city_country(sender, instance, **kwargs):
     if instance.region_id and not instance.country_id:
         instance.country = instance.region.country
+# before the receivers which read the country of the city
 signals.pre_save.connect(city_country, sender=City)
+signals.pre_save.connect(set_name_ascii, sender=City)
+signals.pre_save.connect(set_display_name, sender=City)
 
 
-def city_autocomplete_prefixes(sender, instance, **kwargs):
-    city_name = to_search(instance.name)
-    region_name = ''
-    if instance.region_id:
-        region_name = to_search(instance.region.name)
-    country_name = to_search(instance.country.name)
+def set_scaled_coordinates(sender, instance, **kwargs):
+    """
+    Signal receiver that sets instance.scaled_latitude and scaled_longitude
+    from latitude and longitude.
+    """
+    instance.scaled_latitude = scale_coordinate(instance.latitude)
+    instance.scaled_longitude = scale_coordinate(instance.longitude)
+signals.pre_save.connect(set_scaled_coordinates, sender=City)
+
+
+def display_name_expression(suffix):
+    """
+    Return an expression for name followed by suffix, to compute
+    display_name in the database.
+    """
+    return Concat('name', models.Value(suffix),
+        output_field=models.CharField())
 
-    queries = [city_name, ('%s%s' % (city_name, region_name))]
 
+def update_region_display_names(region, country_name=None):
+    """
+    Rebuild the display_name of the cities of region with a single UPDATE,
+    which skips cities that are up to date. Return the number of cities
+    updated.
+    """
+    if country_name is None:
+        country_name = Country.objects.filter(pk=region.country_id
+            ).values_list('name', flat=True)[0]
+
+    display_name = display_name_expression(u', %s, %s' % (region.name,
+        country_name))
+    return City.objects.filter(region_id=region.pk).exclude(
+        display_name=display_name).update(display_name=display_name)
+
+
+def update_country_display_names(country):
+    """
+    Rebuild the display_name of the regions and cities of country, with one
+    UPDATE for its regions, one for its cities without region and one for
+    the others, which reads the name of their region with a subquery. Return
+    the number of rows updated.
+    """
+    suffix = u', %s' % country.name
+
+    display_name = display_name_expression(suffix)
+    updated = Region.objects.filter(country_id=country.pk).exclude(
+        display_name=display_name).update(display_name=display_name)
+    updated += City.objects.filter(country_id=country.pk,
+        region=None).exclude(display_name=display_name).update(
+        display_name=display_name)
+
+    region_name = RawSQL('SELECT name FROM %s WHERE %s.id = %s.region_id' % (
+        Region._meta.db_table, Region._meta.db_table, City._meta.db_table),
+        (), output_field=models.CharField())
+    display_name = Concat('name', models.Value(u', '), region_name,
+        models.Value(suffix), output_field=models.CharField())
+    updated += City.objects.filter(country_id=country.pk).exclude(
+        region=None).exclude(display_name=display_name).update(
+        display_name=display_name)
+
+    return updated
+
+
+def update_city_search_names(instance):
+    """
+    Rebuild the search_names of the cities of a country or region. Return
+    the number of cities updated.
+    """
+    if isinstance(instance, Country):
+        cities = City.objects.filter(country_id=instance.pk)
+    else:
+        cities = City.objects.filter(region_id=instance.pk)
+    return update_search_names(cities)
+
+
+def remember_names(sender, instance, **kwargs):
+    """
+    Keep the name and alternate_names an instance was loaded with, to detect
+    renames.
+    """
+    instance._loaded_names = (instance.__dict__.get('name', None),
+        instance.__dict__.get('alternate_names', None))
+
+
+def propagate_display_names(sender, instance, created=False, raw=False,
+        **kwargs):
+    """
+    Signal receiver that rebuilds the display_name and search_names of the
+    rows depending on a renamed country or region, or only the search_names
+    of its cities if its alternate_names changed, according to
+    DISPLAY_NAME_PROPAGATION.
+    """
+    loaded_name, loaded_alternate_names = getattr(instance, '_loaded_names',
+        (None, None))
+    instance._loaded_names = (instance.name, instance.alternate_names)
+
+    if not DISPLAY_NAME_PROPAGATION or created or raw:
+        return
+
+    if loaded_name is None:
+        return
+
+    functions = []
+    if loaded_name != instance.name:
+        if sender is Country:
+            functions.append(update_country_display_names)
+        else:
+            functions.append(update_region_display_names)
+
+    if loaded_name != instance.name or \
+            loaded_alternate_names != instance.alternate_names:
+        functions.append(update_city_search_names)
+
+    if not functions:
+        return
+
+    def propagate():
+        for function in functions:
+            function(instance)
+
+    if DISPLAY_NAME_PROPAGATION != 'background':
+        propagate()
+        return
+
+    def propagate_in_thread():
+        try:
+            propagate()
+        finally:
+            connection.close()
+
+    transaction.on_commit(
+        lambda: threading.Thread(target=propagate_in_thread).start())
+
+signals.post_init.connect(remember_names, sender=Country)
+signals.post_init.connect(remember_names, sender=Region)
+signals.post_save.connect(propagate_display_names, sender=Country)
+signals.post_save.connect(propagate_display_names, sender=Region)
+
+
+def name_prefixes(city_name, region_name=None):
+    """
+    Return the set of City_Name_Prefix prefixes of a city: every prefix of
+    at least 3 characters of to_search(city_name), and of the same followed
+    by to_search(region_name).
+    """
+    city_name = to_search(city_name)
+    queries = [city_name]
+    if region_name:
+        queries.append('%s%s' % (city_name, to_search(region_name)))
+
+    max_length = City_Name_Prefix._meta.get_field('prefix').max_length
+    prefixes = set()
     for query_full in queries:
-        for i in range (3, len(query_full)+1):
-            query = query_full[:i]
-            prefix_entry = None
-            try:
-                prefix_entry = City_Name_Prefix.objects.get(prefix=query)
-            except City_Name_Prefix.DoesNotExist:
-                prefix_entry = City_Name_Prefix.objects.create(prefix=query)
-            instance.autocomplete_prefixes.add(prefix_entry)
+        for i in range(3, min(len(query_full), max_length) + 1):
+            prefixes.add(query_full[:i])
+    return prefixes
+
+
+def city_autocomplete_prefixes(sender, instance, **kwargs):
+    region_name = None
+    if instance.region_id:
+        region_name = instance.region.name
+
+    for query in name_prefixes(instance.name, region_name):
+        prefix_entry = None
+        try:
+            prefix_entry = City_Name_Prefix.objects.get(prefix=query)
+        except City_Name_Prefix.DoesNotExist:
+            prefix_entry = City_Name_Prefix.objects.create(prefix=query)
+        instance.autocomplete_prefixes.add(prefix_entry)
 
 #signals.post_save.connect(city_autocomplete_prefixes, sender=City)
 
-#def city_search_names(sender, instance, **kwargs):
-#    search_names = []
-#
-#    country_names = [instance.country.name]
-#    if instance.country.alternate_names:
-#        country_names += instance.country.alternate_names.split(',')
-#
-#    city_names = [instance.name]
-#    if instance.alternate_names:
-#        city_names += instance.alternate_names.split(',')
-#
-#    if instance.region_id:
-#        region_names = [instance.region.name]
-#        if instance.region.alternate_names:
-#            region_names += instance.region.alternate_names.split(',')
-#
-#    for city_name in city_names:
-#        for country_name in country_names:
-#            name = to_search(city_name + country_name)
-#            if name not in search_names:
-#                search_names.append(name)
-#
-#            if instance.region_id:
-#                for region_name in region_names:
-#                    name = to_search(city_name + region_name + country_name)
-#                    if name not in search_names:
-#                        search_names.append(name)
-#
-#    instance.search_names = ' '.join(search_names)
-#signals.pre_save.connect(city_search_names, sender=City)
+
+def all_names(name, alternate_names):
+    """
+    Return the list of name and of the comma separated alternate_names.
+    """
+    names = [name]
+    if alternate_names:
+        names += alternate_names.split(',')
+    return names
+
+
+def get_search_names(city_names, region_names, country_names):
+    """
+    Return the search_names of a city, given the lists of names of the city,
+    its region, empty if it has none, and its country: to_search() of each
+    city name followed by each country name, and by each region name and
+    each country name.
+    """
+    search_names = []
+
+    for city_name in city_names:
+        for country_name in country_names:
+            name = to_search(city_name + country_name)
+            if name not in search_names:
+                search_names.append(name)
+
+            for region_name in region_names:
+                name = to_search(city_name + region_name + country_name)
+                if name not in search_names:
+                    search_names.append(name)
+
+    return ' '.join(search_names)
+
+
+def city_search_names(sender, instance, **kwargs):
+    """
+    Signal receiver that sets instance.search_names from the names of the
+    city, its region and its country.
+    """
+    region_names = []
+    if instance.region_id:
+        region_names = all_names(instance.region.name,
+            instance.region.alternate_names)
+
+    instance.search_names = get_search_names(
+        all_names(instance.name, instance.alternate_names), region_names,
+        all_names(instance.country.name, instance.country.alternate_names))
+signals.pre_save.connect(city_search_names, sender=City)
+
+
+def names_by_pk(queryset):
+    """
+    Return a dict of pk -> all_names() for a Country or Region queryset.
+    """
+    return dict((pk, all_names(name, alternate_names)) for pk, name,
+        alternate_names in queryset.values_list('pk', 'name',
+        'alternate_names'))
+
+
+def update_search_names(cities, region_names=None, country_names=None):
+    """
+    Rebuild the search_names of the cities of a City queryset without
+    sending pre_save: one query reads them, those which changed are written
+    back with bulk_update(). region_names and country_names are names_by_pk()
+    dicts, read for the regions and countries of the cities if None. Return
+    the number of cities updated.
+    """
+    if region_names is None:
+        region_names = names_by_pk(Region.objects.filter(
+            pk__in=cities.values('region_id')))
+    if country_names is None:
+        country_names = names_by_pk(Country.objects.filter(
+            pk__in=cities.values('country_id')))
+
+    changed = []
+    for pk, name, alternate_names, region_id, country_id, current in \
+            cities.values_list('pk', 'name', 'alternate_names', 'region_id',
+            'country_id', 'search_names'):
+        search_names = get_search_names(all_names(name, alternate_names),
+            region_names.get(region_id, []), country_names.get(country_id, []))
+
+        if search_names != current:
+            changed.append(cities.model(pk=pk, search_names=search_names))
+
+    return bulk_update(cities.model, changed, ['search_names'])
 
 
@@ -0,0 +1,156 @@
+"""
+City search backends.
+
+The contrib lookups, autocompletes and API call search_cities(), which
+delegates to the backend of the database: all return the cities matching
+the to_search() form of the query, most populated first, each with the
+index created by migrations 0003 and 0004.
+
+The backends do not match the same way. search_names is a space separated
+list of to_search() names, and the full text indexes of MySQL and SQLite
+only match words of search_names which start with the query, while
+icontains also matches inside words: 'aris' finds Paris with
+IcontainsSearchBackend only. Queries which start like a name, as typed in
+autocompletes, get the same results with every backend.
+
+IcontainsSearchBackend
+    Plain search_names__icontains filter, served on PostgreSQL by the
+    pg_trgm GIN index. Used when INDEX_SEARCH_NAMES is False.
+
+MySQLSearchBackend
+    MATCH ... AGAINST on the FULLTEXT index, matching words of search_names
+    which start with the query.
+
+SQLiteSearchBackend
+    Lookup in the cities_light_city_search FTS5 table, matching words of
+    search_names which start with the query. Falls back to icontains if
+    SQLite was built without FTS5. The table is defined once, in
+    cities_light.migrations._search_index: migrations which change the
+    schema of City must call its sqlite_sync() on SQLite, which rebuilds
+    cities_light_city without the triggers of the table.
+
+SEARCH_BACKEND can be set to the dotted path of another class.
+"""
+
+from django.db import connections, router
+from django.utils.module_loading import import_string
+
+from .migrations._search_index import SQLITE_TABLE, sqlite_sync
+from .models import City, to_search
+from .settings import *
+
+__all__ = ['IcontainsSearchBackend', 'MySQLSearchBackend',
+    'SQLiteSearchBackend', 'get_backend', 'search_cities']
+
+
+class IcontainsSearchBackend(object):
+    """
+    Base search backend, filters search_names with icontains.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.connection = connections[using]
+
+    def filter(self, queryset, q):
+        """
+        Return queryset filtered on q, which is already passed through
+        to_search().
+        """
+        return queryset.filter(search_names__icontains=q)
+
+    def search(self, queryset, q):
+        """
+        Return the cities of queryset matching q, most populated first.
+        """
+        q = to_search(q)
+        if q:
+            queryset = self.filter(queryset, q)
+        return queryset.order_by('-population', 'pk')
+
+    def sync(self):
+        """
+        Bring the search index up to date with search_names, if the database
+        does not maintain it.
+        """
+        pass
+
+
+class MySQLSearchBackend(IcontainsSearchBackend):
+    """
+    Search backend using the FULLTEXT index on search_names in boolean mode.
+    """
+
+    def filter(self, queryset, q):
+        return queryset.extra(
+            where=['MATCH (cities_light_city.search_names) AGAINST '
+                '(%s IN BOOLEAN MODE)'],
+            params=['%s*' % q])
+
+
+class SQLiteSearchBackend(IcontainsSearchBackend):
+    """
+    Search backend using the cities_light_city_search FTS5 table.
+    """
+
+    table = SQLITE_TABLE
+
+    def has_table(self):
+        if not hasattr(self, '_has_table'):
+            self._has_table = self.table in \
+                self.connection.introspection.table_names()
+        return self._has_table
+
+    def filter(self, queryset, q):
+        if not self.has_table():
+            return super(SQLiteSearchBackend, self).filter(queryset, q)
+
+        return queryset.extra(
+            where=['cities_light_city.id IN (SELECT rowid FROM %s WHERE '
+                '%s MATCH %%s)' % (self.table, self.table)],
+            params=['"%s"*' % q])
+
+    def sync(self):
+        """
+        Recreate the triggers, which SQLite drops when a migration rebuilds
+        cities_light_city, and rebuild the FTS5 table from search_names.
+        """
+        sqlite_sync(self.connection)
+
+
+backends = {}
+
+
+def get_backend(using=None):
+    """
+    Return the search backend instance for the database alias of City.
+    """
+    if using is None:
+        using = router.db_for_read(City)
+
+    if using not in backends:
+        vendor = connections[using].vendor
+
+        if SEARCH_BACKEND:
+            backend_class = import_string(SEARCH_BACKEND)
+        elif INDEX_SEARCH_NAMES and vendor == 'mysql':
+            backend_class = MySQLSearchBackend
+        elif INDEX_SEARCH_NAMES and vendor == 'sqlite':
+            backend_class = SQLiteSearchBackend
+        else:
+            backend_class = IcontainsSearchBackend
+
+        backends[using] = backend_class(using)
+
+    return backends[using]
+
+
+def search_cities(q, queryset=None):
+    """
+    Return the cities matching q, most populated first, from queryset which
+    defaults to all cities.
+    """
+    if queryset is None:
+        queryset = City.objects.all()
+
+    return get_backend(queryset.db).search(queryset, q)
@@ -40,10 +40,79 @@ DATA_DIR
     Absolute path to download and extract data into. Default is
     cities_light/data. Overridable in settings.CITIES_LIGHT_DATA_DIR
 
+DELTA_URL
+    Base url of the GeoNames daily modifications-YYYY-MM-DD.txt,
+    deletes-YYYY-MM-DD.txt, alternateNamesModifications-YYYY-MM-DD.txt and
+    alternateNamesDeletes-YYYY-MM-DD.txt files applied by cities_light
+    --delta. Default is http://download.geonames.org/export/dump/.
+    Overridable in settings.CITIES_LIGHT_DELTA_URL.
+
+DELTA_MIN_POPULATION
+    Cities which are not in the database yet are only inserted by
+    cities_light --delta if their population is at least this. Default is
+    15000, like the default cities15000 CITY_SOURCES. Overridable in
+    settings.CITIES_LIGHT_DELTA_MIN_POPULATION.
+
+DELTA_RETENTION_DAYS
+    Number of days GeoNames keeps the daily files online. cities_light
+    --delta skips the days older than this, which would fail to download,
+    and warns that a full import is needed to catch up. Default is 30.
+    Overridable in settings.CITIES_LIGHT_DELTA_RETENTION_DAYS.
+
+EXTRACT_SOURCES
+    If True, the default, zip sources are extracted into DATA_DIR before
+    parsing. If False, rows are decompressed on the fly from the archive,
+    which saves the disk space and I/O of the extracted copy. Overridable in
+    settings.CITIES_LIGHT_EXTRACT_SOURCES, or with the --no-extract option.
+
+IMPORT_BATCH_SIZE
+    Number of parsed rows the cities_light command buffers before resolving
+    and writing them in bulk. Default is 500, which keeps every query under
+    SQLite's limit of 999 parameters. Overridable in
+    settings.CITIES_LIGHT_IMPORT_BATCH_SIZE, or with the --batch-size option.
+
+IMPORT_TRANSACTION_SIZE
+    Number of rows the cities_light command imports per transaction. If a
+    transaction fails, it is rolled back and the import stops, rows of the
+    previous transactions stay committed. Default is 5000. Overridable in
+    settings.CITIES_LIGHT_IMPORT_TRANSACTION_SIZE, or with the
+    --transaction-size option.
+
+TRANSLATION_MEMORY_LIMIT
+    Approximate number of megabytes of parsed alternate names the
+    cities_light command keeps in memory before spilling them to sorted
+    temporary files in DATA_DIR. Default is 64. Overridable in
+    settings.CITIES_LIGHT_TRANSLATION_MEMORY_LIMIT, or with the
+    --translation-memory-limit option.
+
+DISPLAY_NAME_PROPAGATION
+    What to do with the display_name of the regions and cities of a country
+    or region which is renamed, and with the search_names of its cities,
+    which also change with its alternate_names. If 'sync', the default,
+    they are rebuilt with a few UPDATE queries right after the country or
+    region is saved. If 'background', the same queries run in a thread once
+    the transaction is committed. If None, they are left out of date.
+    Overridable in settings.CITIES_LIGHT_DISPLAY_NAME_PROPAGATION.
+
+AUTOCOMPLETE_INDEX
+    If True, the contrib autocompletes, lookups and city list API search
+    cities with cities_light.autocomplete, an index of city names held in
+    memory by each process and ranked by population, instead of querying
+    search_names. Default is False. Overridable in
+    settings.CITIES_LIGHT_AUTOCOMPLETE_INDEX.
+
 INDEX_SEARCH_NAMES
-    If your database engine for cities_light supports indexing TextFields (ie.
-    it is **not** MySQL), then this should be set to True. You might have to
-    override this setting if using several databases for your project.
+    If True, the default, migration 0003 indexes City.search_names for the
+    database backend: a pg_trgm GIN index on PostgreSQL, which serves
+    icontains lookups, and an FTS5 table kept in sync by triggers on SQLite.
+    Migration 0004 adds a FULLTEXT index on MySQL. Set it to False before
+    migrating to skip the indexes. Overridable in
+    settings.CITIES_LIGHT_INDEX_SEARCH_NAMES.
+
+SEARCH_BACKEND
+    Dotted path to the class cities_light.search uses to search cities. If
+    None, the default, it is chosen from the database backend and
+    INDEX_SEARCH_NAMES. Overridable in settings.CITIES_LIGHT_SEARCH_BACKEND.
 """
 
 import os.path
@@ -52,7 +121,11 @@ from django.conf import settings
 
 __all__ = ['COUNTRY_SOURCES', 'REGION_SOURCES', 'CITY_SOURCES',
     'TRANSLATION_LANGUAGES', 'TRANSLATION_SOURCES', 'SOURCES', 'DATA_DIR',
-    'INDEX_SEARCH_NAMES', ]
+    'INDEX_SEARCH_NAMES', 'DELTA_URL', 'DELTA_MIN_POPULATION',
+    'DELTA_RETENTION_DAYS', 'EXTRACT_SOURCES', 'IMPORT_BATCH_SIZE',
+    'IMPORT_TRANSACTION_SIZE', 'TRANSLATION_MEMORY_LIMIT',
+    'DISPLAY_NAME_PROPAGATION',
+    'AUTOCOMPLETE_INDEX', 'SEARCH_BACKEND', ]
 
 COUNTRY_SOURCES = getattr(settings, 'CITIES_LIGHT_COUNTRY_SOURCES',
     ['http://download.geonames.org/export/dump/countryInfo.txt'])
@@ -72,10 +145,23 @@ DATA_DIR = getattr(settings, 'CITIES_LIGHT_DATA_DIR',
     os.path.normpath(os.path.join(
         os.path.dirname(os.path.realpath(__file__)), 'data')))
 
-# MySQL doesn't support indexing TextFields
-INDEX_SEARCH_NAMES = getattr(settings, 'CITIES_LIGHT_INDEX_SEARCH_NAMES', None)
-if INDEX_SEARCH_NAMES is None:
-    INDEX_SEARCH_NAMES = True
-    for database in settings.DATABASES.values():
-        if 'mysql' in database['ENGINE'].lower():
-            INDEX_SEARCH_NAMES = False
+DELTA_URL = getattr(settings, 'CITIES_LIGHT_DELTA_URL',
+    'http://download.geonames.org/export/dump/')
+DELTA_MIN_POPULATION = getattr(settings, 'CITIES_LIGHT_DELTA_MIN_POPULATION',
+    15000)
+DELTA_RETENTION_DAYS = getattr(settings, 'CITIES_LIGHT_DELTA_RETENTION_DAYS',
+    30)
+
+EXTRACT_SOURCES = getattr(settings, 'CITIES_LIGHT_EXTRACT_SOURCES', True)
+IMPORT_BATCH_SIZE = getattr(settings, 'CITIES_LIGHT_IMPORT_BATCH_SIZE', 500)
+IMPORT_TRANSACTION_SIZE = getattr(settings,
+    'CITIES_LIGHT_IMPORT_TRANSACTION_SIZE', 5000)
+TRANSLATION_MEMORY_LIMIT = getattr(settings,
+    'CITIES_LIGHT_TRANSLATION_MEMORY_LIMIT', 64)
+DISPLAY_NAME_PROPAGATION = getattr(settings,
+    'CITIES_LIGHT_DISPLAY_NAME_PROPAGATION', 'sync')
+AUTOCOMPLETE_INDEX = getattr(settings, 'CITIES_LIGHT_AUTOCOMPLETE_INDEX',
+    False)
+
+INDEX_SEARCH_NAMES = getattr(settings, 'CITIES_LIGHT_INDEX_SEARCH_NAMES', True)
+SEARCH_BACKEND = getattr(settings, 'CITIES_LIGHT_SEARCH_BACKEND', None)
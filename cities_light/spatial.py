@@ -0,0 +1,210 @@
+"""
+In-memory spatial index of cities, for proximity queries without PostGIS.
+
+CityTree is a k-d tree over the positions of cities as 3D unit vectors: the
+straight line (chord) distance between two vectors grows with the great
+circle distance, and has no discontinuity at the poles or at the
+antimeridian, so the tree can prune on plain coordinates. Distances are
+converted to kilometers on the way out.
+
+nearest() and within() use the tree of the current process, built on first
+use and rebuilt in a thread after each import, like the autocomplete index.
+"""
+
+import array
+import heapq
+import math
+from operator import itemgetter
+
+from .autocomplete import ReloadingIndex
+from .models import City, EARTH_RADIUS_KM
+
+__all__ = ['CityTree', 'nearest', 'within', 'EARTH_RADIUS_KM']
+
+
+def to_vector(latitude, longitude):
+    """
+    Return the (x, y, z) unit vector of a position in degrees.
+    """
+    latitude = math.radians(latitude)
+    longitude = math.radians(longitude)
+    cos_latitude = math.cos(latitude)
+    return (cos_latitude * math.cos(longitude),
+        cos_latitude * math.sin(longitude), math.sin(latitude))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+
+def km_to_chord(km):
+    angle = km / EARTH_RADIUS_KM
+    if angle >= math.pi:
+        return 2.0
+    return 2 * math.sin(angle / 2)
+
+
+class CityTree(object):
+    """
+    Implicit k-d tree of cities.
+
+    Points are stored in arrays, ordered so that the middle point of each
+    range is the node splitting it on axes[middle], the coordinate with the
+    largest spread in the range. Ranges of leaf_size points or less are
+    scanned.
+    """
+
+    leaf_size = 8
+
+    def __init__(self, points):
+        """
+        points is a list of (pk, population, x, y, z) tuples.
+        """
+        points = list(points)
+        self.axes = array.array('b', [0] * len(points))
+        self.split(points)
+
+        self.pks = array.array('i', [p[0] for p in points])
+        self.populations = array.array('d', [p[1] for p in points])
+        self.coordinates = [array.array('d', [p[axis + 2] for p in points])
+            for axis in range(3)]
+
+    @classmethod
+    def build(cls):
+        """
+        Return a CityTree of all cities with coordinates, with one query.
+        """
+        rows = City.objects.exclude(latitude=None).exclude(longitude=None
+            ).order_by().values_list('pk', 'population', 'latitude',
+            'longitude')
+
+        return cls((pk, population or 0) + to_vector(float(latitude),
+            float(longitude))
+            for pk, population, latitude, longitude in rows.iterator())
+
+    def split(self, points):
+        ranges = [(0, len(points))]
+        while ranges:
+            start, end = ranges.pop()
+            if end - start <= self.leaf_size:
+                continue
+
+            segment = points[start:end]
+            spreads = []
+            for axis in range(3):
+                values = [p[axis + 2] for p in segment]
+                spreads.append(max(values) - min(values))
+            axis = spreads.index(max(spreads))
+
+            segment.sort(key=itemgetter(axis + 2))
+            points[start:end] = segment
+
+            middle = (start + end) // 2
+            self.axes[middle] = axis
+            ranges.append((start, middle))
+            ranges.append((middle + 1, end))
+
+    def search(self, vector, limit, radius, min_population):
+        """
+        Return a heap of (-squared chord, index) of the limit points closest
+        to vector within the squared chord radius, limit may be None.
+        """
+        heap = []
+        if limit is not None and limit <= 0:
+            return heap
+
+        ranges = [(0, len(self.pks), 0.0)]
+        coordinates = self.coordinates
+        xs, ys, zs = coordinates
+        x, y, z = vector
+        populations = self.populations
+
+        def bound():
+            if limit is not None and len(heap) >= limit:
+                return min(radius, -heap[0][0])
+            return radius
+
+        def visit(i):
+            if min_population and populations[i] < min_population:
+                return
+
+            dx, dy, dz = xs[i] - x, ys[i] - y, zs[i] - z
+            distance = dx * dx + dy * dy + dz * dz
+            if distance > bound():
+                return
+
+            if limit is not None and len(heap) >= limit:
+                heapq.heapreplace(heap, (-distance, i))
+            else:
+                heapq.heappush(heap, (-distance, i))
+
+        while ranges:
+            start, end, lower_bound = ranges.pop()
+            if lower_bound > bound():
+                continue
+
+            if end - start <= self.leaf_size:
+                for i in range(start, end):
+                    visit(i)
+                continue
+
+            middle = (start + end) // 2
+            visit(middle)
+
+            axis = self.axes[middle]
+            offset = vector[axis] - coordinates[axis][middle]
+            near, far = (start, middle), (middle + 1, end)
+            if offset > 0:
+                near, far = far, near
+
+            # the near side is popped first
+            ranges.append(far + (max(lower_bound, offset ** 2),))
+            ranges.append(near + (lower_bound,))
+
+        return heap
+
+    def results(self, heap):
+        return [(self.pks[i], chord_to_km(math.sqrt(-distance)))
+            for distance, i in sorted(heap, reverse=True)]
+
+    def nearest(self, latitude, longitude, k=1, min_population=None):
+        """
+        Return the (pk, distance in km) of the k cities nearest to a
+        position, closest first, ignoring cities with less than
+        min_population inhabitants.
+        """
+        heap = self.search(to_vector(latitude, longitude), k, 4.0,
+            min_population)
+        return self.results(heap)
+
+    def within(self, latitude, longitude, radius_km, min_population=None):
+        """
+        Return the (pk, distance in km) of the cities within radius_km of a
+        position, closest first.
+        """
+        heap = self.search(to_vector(latitude, longitude), None,
+            km_to_chord(radius_km) ** 2, min_population)
+        return self.results(heap)
+
+    def __len__(self):
+        return len(self.pks)
+
+reloading_tree = ReloadingIndex(CityTree)
+
+
+def nearest(latitude, longitude, k=1, min_population=None):
+    """
+    Return the (pk, distance in km) of the k cities nearest to a position,
+    using the tree of the current process.
+    """
+    return reloading_tree.get().nearest(latitude, longitude, k,
+        min_population)
+
+
+def within(latitude, longitude, radius_km, min_population=None):
+    """
+    Return the (pk, distance in km) of the cities within radius_km of a
+    position, using the tree of the current process.
+    """
+    return reloading_tree.get().within(latitude, longitude, radius_km,
+        min_population)
@@ -1,12 +1,48 @@
 # -*- encoding: utf-8 -*-
 
-from django.utils import unittest
+import datetime
+import importlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import skipIf
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from django.apps import apps
+from django.db import connection
+from django.test import RequestFactory, TestCase
 
 from .forms import CountryForm, CityForm
-from .models import Country, City
+from .management.commands.cities_light import Command
+from .management.commands import cities_light_build_prefixes
+from .models import Country, Region, City
+from .autocomplete import CityIndex, ReloadingIndex, city_keys, \
+    data_version
+from .bulk import AlternateNamesWriter
+from .fingerprints import Fingerprints
+from .geonames import Geonames, AlternateNamesFilter, parse_chunk
+from .search import IcontainsSearchBackend, MySQLSearchBackend, \
+    SQLiteSearchBackend, get_backend, search_cities
+from . import spatial
+from .spatial import CityTree, to_vector
+from .index import IdentityMap, ModelIndex
+from .settings import DELTA_RETENTION_DAYS, REGION_SOURCES
+from .translations import TranslationBuffer, TranslationCache
+
+try:
+    from .contrib import restframework
+except ImportError:
+    restframework = None
 
 
-class FormTestCase(unittest.TestCase):
+class FormTestCase(TestCase):
     def testCountryFormNameAndContinentAlone(self):
         form = CountryForm({'name': 'Spain', 'continent': 'EU'})
         self.assertTrue(form.is_valid())
@@ -20,7 +56,7 @@ class FormTestCase(unittest.TestCase):
         form.save()
 
 
-class SaveTestCase(unittest.TestCase):
+class SaveTestCase(TestCase):
     def testCountryAsciiAndSlug(self):
         country = Country(name=u'áó éú')
         country.save()
@@ -29,8 +65,876 @@ class SaveTestCase(unittest.TestCase):
         self.assertEqual(country.slug, u'ao-eu')
 
     def testCityAsciiAndSlug(self):
-        city = City(name=u'áó éú', country_id=1)
+        country = Country(name='France')
+        country.save()
+        city = City(name=u'áó éú', country_id=country.pk)
         city.save()
 
         self.assertEqual(city.name_ascii, u'ao eu')
         self.assertEqual(city.slug, u'ao-eu')
+
+
+class IdentityMapTestCase(TestCase):
+    def testLoadAndLookup(self):
+        country = Country(name='Belgium', code2='BE', geoname_id=2802361)
+        country.save()
+
+        index = ModelIndex(Country, code2=('code2',),
+            geoname_id=('geoname_id',)).load()
+
+        self.assertTrue('BE' in index['code2'])
+        self.assertEqual(index['code2']['BE'], country.pk)
+        self.assertEqual(index.get('geoname_id', 2802361), country.pk)
+
+    def testMissIsCached(self):
+        identity_map = IdentityMap(Country, ('code2',))
+        self.assertRaises(Country.DoesNotExist, lambda: identity_map['ZZ'])
+
+        # created behind the map's back: the miss was remembered
+        Country(name='Zedland', code2='ZZ').save()
+        self.assertRaises(Country.DoesNotExist, lambda: identity_map['ZZ'])
+
+        identity_map.add('ZZ', 42)
+        self.assertEqual(identity_map['ZZ'], 42)
+
+
+class TranslationBufferTestCase(TestCase):
+    def testSpilledRunsAreMergedPerGeonameId(self):
+        buffer = TranslationBuffer(memory_limit=0,
+            directory=tempfile.gettempdir())
+
+        buffer.add(City, 2, 'en', 'Brussels')
+        buffer.add(Country, 1, 'fr', 'Belgique')
+        buffer.add(City, 2, 'es', 'Bruselas')
+        buffer.add(City, 2, 'en', 'Bruxelles')
+
+        self.assertEqual(len(buffer.runs), 4)
+        self.assertEqual(list(buffer), [
+            (City, 2, {'en': ['Brussels', 'Bruxelles'], 'es': ['Bruselas']}),
+            (Country, 1, {'fr': ['Belgique']}),
+        ])
+        buffer.close()
+
+
+class TranslationCacheTestCase(TestCase):
+    def setUp(self):
+        fd, self.source_path = tempfile.mkstemp()
+        os.close(fd)
+        self.cache = TranslationCache(self.source_path + '.cache')
+
+    def tearDown(self):
+        self.cache.close()
+        for path in (self.source_path, self.cache.path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def testRoundTripAndInvalidation(self):
+        groups = [
+            (City, 2, {'en': ['Brussels', 'Bruxelles']}),
+            (Country, 1, {'fr': ['Belgique']}),
+        ]
+        self.cache.write(groups, self.source_path, ['en', 'fr'])
+
+        self.assertTrue(self.cache.is_valid(self.source_path, ['fr', 'en']))
+        self.assertFalse(self.cache.is_valid(self.source_path, ['en']))
+
+        self.cache.open()
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(list(self.cache), groups)
+        self.assertEqual(list(self.cache.iter_model(Country)),
+            [(1, {'fr': ['Belgique']})])
+        self.cache.close()
+
+        with open(self.source_path, 'w') as f:
+            f.write('changed')
+        self.assertFalse(self.cache.is_valid(self.source_path, ['en', 'fr']))
+
+
+class GeonamesFileHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for download.geonames.org supporting conditional and range
+    requests.
+    """
+
+    body = '\n'.join(['%s\tCity %s' % (i, i) for i in range(20000)])
+    last_modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get('Range', None))
+
+        if self.headers.get('If-Modified-Since', None) == self.last_modified:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('If-Range', None) == self.last_modified:
+            start = int(self.headers['Range'][6:-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (
+                start, len(self.body) - 1, len(self.body)))
+        else:
+            self.send_response(200)
+
+        self.send_header('Last-Modified', self.last_modified)
+        self.send_header('Content-Length', str(len(self.body) - start))
+        self.end_headers()
+        self.wfile.write(self.body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class ParseTestCase(TestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            for i in range(3000):
+                row = [str(i), str(i % 300), ['en', 'fr', 'zz'][i % 3],
+                    'Nom \xc3\xa9 %s' % i]
+                if i % 7 == 0:
+                    row += ['', '1']
+                f.write('\t'.join(row) + '\n')
+            f.write('# comment\n\n')
+
+        self.geonames = Geonames.__new__(Geonames)
+        self.geonames.file_path = path
+        self.geonames.member = None
+        # many chunks, more than the workers may parse ahead
+        self.geonames.chunk_size = 1024
+
+    def tearDown(self):
+        os.unlink(self.geonames.file_path)
+
+    def testParallelParseMatchesSerial(self):
+        row_filter = AlternateNamesFilter(['en', 'fr'])
+        rows = list(self.geonames.parse(row_filter=row_filter))
+
+        self.assertEqual(len(rows), 1714)
+        self.assertEqual(rows[0], ['1', 1, 'fr', u'Nom \xe9 1'])
+        self.assertEqual(list(self.geonames.parse(workers=2,
+            row_filter=row_filter)), rows)
+        self.assertEqual(self.geonames.position,
+            os.path.getsize(self.geonames.file_path))
+
+    def testZipMemberIsStreamed(self):
+        rows = list(self.geonames.parse())
+        size = os.path.getsize(self.geonames.file_path)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        zip_path = os.path.join(directory, 'alternateNames.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as f:
+            f.writestr('iso-languagecodes.txt', 'eng\ten\tEnglish\n')
+            f.write(self.geonames.file_path, 'alternateNames.txt')
+
+        geonames = Geonames.__new__(Geonames)
+        geonames.file_path = zip_path
+        geonames.member = 'alternateNames.txt'
+        geonames.chunk_size = 1024
+
+        self.assertEqual(geonames.size(), size)
+        self.assertEqual(list(geonames.parse()), rows)
+        self.assertEqual(geonames.position, size)
+        self.assertEqual(list(geonames.parse(workers=2)), rows)
+        self.assertEqual(geonames.position, size)
+        self.assertEqual(os.listdir(directory), ['alternateNames.zip'])
+
+
+class DownloadTestCase(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), GeonamesFileHandler)
+        self.server.ranges = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = 'http://127.0.0.1:%s/cities.txt' % self.server.server_port
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cities.txt')
+        self.geonames = Geonames.__new__(Geonames)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def assertDownloaded(self):
+        with open(self.path, 'r') as f:
+            self.assertEqual(f.read(), GeonamesFileHandler.body)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def testConditionalDownload(self):
+        self.assertTrue(self.geonames.download(self.url, self.path))
+        self.assertDownloaded()
+
+        self.assertFalse(self.geonames.download(self.url, self.path))
+        self.assertTrue(self.geonames.download(self.url, self.path,
+            force=True))
+        self.assertDownloaded()
+
+    def testResumePartialDownload(self):
+        with open(self.path + '.part', 'w') as f:
+            f.write(GeonamesFileHandler.body[:1000])
+        self.geonames.write_meta(self.path, {
+            'part-last-modified': GeonamesFileHandler.last_modified})
+
+        self.assertTrue(self.geonames.download(self.url, self.path))
+        self.assertDownloaded()
+        self.assertEqual(self.server.ranges, ['bytes=1000-'])
+
+
+class AlternateNamesWriterTestCase(TestCase):
+    def testMergeAndRemove(self):
+        country = Country.objects.create(name='Belgium', code2='BE',
+            alternate_names='Belgique,Belgien')
+        other = Country.objects.create(name='Spain', code2='ES')
+        untouched = Country.objects.create(name='France', code2='FR',
+            alternate_names='Frankreich')
+
+        writer = AlternateNamesWriter(Country, batch_size=10)
+        writer.add(country.pk, [u'België', u'Belgique', u'Belgium'])
+        writer.add(other.pk, [u'España'])
+        writer.remove(country.pk, [u'Belgien'])
+        writer.add(untouched.pk, [u'Frankreich'])
+
+        # one query to read, one savepoint, one update, one release
+        with self.assertNumQueries(4):
+            self.assertEqual(writer.flush(), 2)
+
+        # known names and the country's own name are not added twice
+        self.assertEqual(Country.objects.get(pk=country.pk).alternate_names,
+            u'Belgique,België')
+        self.assertEqual(Country.objects.get(pk=other.pk).alternate_names,
+            u'España')
+        self.assertEqual(writer.changed, set([country.pk, other.pk]))
+        self.assertEqual(writer.flush(), 0)
+
+    def testFlushAtBatchSize(self):
+        countries = [Country.objects.create(name='Country %s' % i,
+            code2='X%s' % i) for i in range(3)]
+
+        writer = AlternateNamesWriter(Country, batch_size=2)
+        for country in countries:
+            writer.add(country.pk, [u'Alias'])
+
+        self.assertEqual(writer.updated, 2)
+        self.assertEqual(list(writer.pending), [countries[2].pk])
+
+
+class PrefetchTestCase(TestCase):
+    def testSourceOrderIsKept(self):
+        urls = ['http://example.com/%s.txt' % i for i in range(3)]
+        finished = []
+
+        def download(url):
+            # the first url takes the longest to download
+            time.sleep(0.1 * (len(urls) - urls.index(url)))
+            finished.append(url)
+            return url.upper()
+
+        command = Command()
+        command.setup(download_workers=3)
+
+        self.assertEqual(list(command.prefetch(urls, download)),
+            [(url, url.upper()) for url in urls])
+        self.assertEqual(finished, list(reversed(urls)))
+
+
+class CityBatchImportTestCase(TestCase):
+    def city_row(self, geoname_id, name, population=10000, region='01'):
+        return parse_chunk('\t'.join([str(geoname_id), name, name, '',
+            '50.1', '4.1', 'P', 'PPL', 'XC', '', region, '', '', '',
+            str(population), '', '10', 'Europe/Brussels',
+            '2013-01-02']))[1][0]
+
+    def flush(self, rows):
+        for items in rows:
+            self.command.city_import(items)
+        self.command.city_flush()
+
+    def setUp(self):
+        self.country = Country.objects.create(name='Batch country',
+            code2='XC', geoname_id=4000000)
+        self.region = Region.objects.create(name='Batch region',
+            country=self.country, geoname_code='01', geoname_id=4000002)
+        City.objects.create(name='Oldtown', country=self.country,
+            region=self.region, geoname_id=4000003, population=16000)
+        City.objects.create(name='Nameless', country=self.country,
+            region=self.region)
+
+        self.command = Command()
+        self.command.setup(batch_size=100)
+
+    def testQueriesPerFlush(self):
+        # fetch existing, regions, countries, savepoint, bulk_create,
+        # release, fetch created pks, bulk_update
+        with self.assertNumQueries(8):
+            self.flush([self.city_row(4000003, 'Oldtown', 17000),
+                self.city_row(4000010, 'Town 10'),
+                self.city_row(4000011, 'Town 11')])
+
+        with self.assertNumQueries(8):
+            self.flush([self.city_row(4000004, 'Nameless', 500)] + [
+                self.city_row(i, 'Town %s' % i)
+                for i in range(4000012, 4000020)])
+
+        self.assertEqual(City.objects.get(geoname_id=4000003).population,
+            17000)
+        nameless = City.objects.get(name='Nameless')
+        self.assertEqual(nameless.geoname_id, 4000004)
+        self.assertEqual(nameless.population, 500)
+        self.assertEqual(City.objects.filter(name__startswith='Town '
+            ).count(), 10)
+        self.assertEqual(City.objects.get(geoname_id=4000019).display_name,
+            'Town 4000019, Batch region, Batch country')
+
+    def testConflictFallsBackToSave(self):
+        # unknown to the import index, conflicts with the first row
+        City.objects.create(name='Clash', country=self.country,
+            region=self.region, feature_class='P', feature_code='PPL')
+
+        self.flush([self.city_row(4000030, 'Clash'),
+            self.city_row(4000031, 'Town 31')])
+
+        self.assertEqual(City.objects.get(name='Clash').geoname_id, None)
+        self.assertEqual(City.objects.get(geoname_id=4000031).name,
+            'Town 31')
+        self.assertEqual(
+            self.command.index.cities.get('geoname_id', 4000031),
+            City.objects.get(geoname_id=4000031).pk)
+
+    def testUnchangedRowFillsLateRegion(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(path)
+
+        rows = [self.city_row(4000040, 'Ixelles', region='ZZ'),
+            self.city_row(4000041, 'Town 41')]
+        self.command.fingerprints = Fingerprints(path).load()
+        self.flush(rows)
+        self.command.fingerprints.save()
+        self.assertEqual(City.objects.get(geoname_id=4000040).region, None)
+
+        Region.objects.create(name='Late region', country=self.country,
+            geoname_code='ZZ', geoname_id=4000042)
+
+        # same rows, only the city without region is imported again
+        self.command = Command()
+        self.command.setup(batch_size=100)
+        self.command.fingerprints = Fingerprints(path).load()
+        self.flush(rows)
+
+        self.assertEqual(City.objects.get(geoname_id=4000040).region.name,
+            'Late region')
+        self.assertEqual(self.command.skipped, 1)
+
+        os.unlink(path)
+
+
+class DeltaImportTestCase(TestCase):
+    def city_row(self, geoname_id, name, population):
+        return '\t'.join([str(geoname_id), name, name, '', '50.1', '4.1',
+            'P', 'PPL', 'XB', '', '01', '', '', '', str(population), '',
+            '10', 'Europe/Brussels', '2013-01-02'])
+
+    def apply(self, kind, data):
+        self.command.delta_apply(kind, parse_chunk(data)[1])
+
+    def setUp(self):
+        country = Country.objects.create(name='Delta country', code2='XB',
+            geoname_id=3000000)
+        region = Region.objects.create(name='Delta region', country=country,
+            geoname_code='01', geoname_id=3000002)
+        City.objects.create(name='Oldtown', country=country, region=region,
+            geoname_id=3000003, population=16000)
+        City.objects.create(name='Gone', country=country, region=region,
+            geoname_id=3000005, population=16000)
+
+        self.command = Command()
+        self.command.setup(batch_size=10)
+
+    def testModifications(self):
+        self.apply('modifications', '\n'.join([
+            self.city_row(3000003, 'Oldtown on Sea', 17000),
+            self.city_row(3000001, 'Newtown', 20000),
+            self.city_row(3000004, 'Hamlet', 10),
+        ]))
+
+        city = City.objects.get(geoname_id=3000003)
+        self.assertEqual(city.name, 'Oldtown on Sea')
+        self.assertEqual(city.population, 17000)
+        self.assertEqual(City.objects.get(geoname_id=3000001).display_name,
+            'Newtown, Delta region, Delta country')
+        self.assertFalse(City.objects.filter(geoname_id=3000004).exists())
+
+    def testDeletes(self):
+        self.apply('deletes', '3000005\tGone\tduplicate')
+        self.assertFalse(City.objects.filter(geoname_id=3000005).exists())
+
+    def testDeleteThenInsert(self):
+        self.apply('deletes', '\n'.join(['3000002\tDelta region\tmerged',
+            '3000005\tGone\tduplicate']))
+        self.apply('modifications', '\n'.join([
+            self.city_row(3000001, 'Newtown', 20000),
+            self.city_row(3000006, 'Gone', 20000),
+        ]))
+
+        # the deleted region is not resolved from the index anymore
+        self.assertIsNone(City.objects.get(geoname_id=3000001).region_id)
+        self.assertIsNone(City.objects.get(geoname_id=3000003).region_id)
+        # the deleted city is not matched by name either
+        self.assertTrue(City.objects.filter(geoname_id=3000006).exists())
+        self.assertEqual(self.command.index.cities.get('geoname_id', 3000003),
+            City.objects.get(geoname_id=3000003).pk)
+        self.assertEqual(self.command.index.regions.values, {})
+
+    def testSkipDaysPastRetention(self):
+        days = []
+        today = datetime.date.today()
+        self.command.delta_last_date = lambda: today - datetime.timedelta(
+            days=100)
+        self.command.delta_save_date = days.append
+        self.command.delta_day = lambda day: None
+
+        self.command.delta_import()
+
+        self.assertEqual(days[0], today - datetime.timedelta(
+            days=DELTA_RETENTION_DAYS))
+        self.assertEqual(days[-1], today - datetime.timedelta(days=1))
+
+    def testAlternateNames(self):
+        self.apply('alternateNamesModifications', '\n'.join([
+            '1\t3000003\ten\tOld Town',
+            '2\t3000003\ten\tOld Town Historic\t\t\t\t1',
+            '3\t3000003\tzz\tOldtoon',
+        ]))
+        self.assertEqual(City.objects.get(geoname_id=3000003).alternate_names,
+            'Old Town')
+
+        self.apply('alternateNamesDeletes', '1\t3000003\tOld Town\twrong')
+        self.assertEqual(City.objects.get(geoname_id=3000003).alternate_names,
+            '')
+
+    def testSearchNamesOfChangedCitiesOnly(self):
+        City.objects.filter(geoname_id=3000005).update(search_names='stale')
+
+        self.apply('alternateNamesModifications', '1\t3000003\ten\tOld Town')
+        self.command.search_names_update()
+
+        self.assertIn('oldtowndeltacountry', City.objects.get(
+            geoname_id=3000003).search_names.split())
+        self.assertEqual(City.objects.get(geoname_id=3000005).search_names,
+            'stale')
+
+        # nothing changed since
+        with self.assertNumQueries(0):
+            self.command.search_names_update()
+
+
+class ErrorLogger(object):
+    """
+    Logger recording error messages in a list, ignoring the others.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+
+    def error(self, message):
+        self.errors.append(message)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class TransactionBatchesTestCase(TestCase):
+    def setUp(self):
+        Country.objects.create(name='Batch country', code2='XD')
+
+        self.command = Command()
+        self.command.setup(transaction_size=2)
+        self.errors = []
+        self.command.logger = ErrorLogger(self.errors)
+
+    def testFailedBatchIsRolledBack(self):
+        rows = [[code, 'Region %s' % code, 'Region %s' % code,
+            str(5000000 + i)] for i, code in enumerate(
+            ['XD.01', 'XD.02', 'XD.03', 'ZZ.01', 'XD.05'])]
+
+        imported = []
+        with self.assertRaises(Country.DoesNotExist):
+            for row in self.command.source_import(REGION_SOURCES[0],
+                    'admin1CodesASCII.txt', rows):
+                imported.append(row)
+
+        self.assertEqual(imported, [2])
+        self.assertEqual(self.errors,
+            ['Rolled back rows 3 to 4 of admin1CodesASCII.txt'])
+        # the first batch stays committed, the failed one left nothing
+        self.assertEqual(sorted(Region.objects.values_list('geoname_code',
+            flat=True)), ['01', '02'])
+
+
+class NoSignalsTestCase(TestCase):
+    def testDenormalizedFieldsMatchSignals(self):
+        country = Country.objects.create(name=u'R\xe9union', code2='RE',
+            geoname_id=935317)
+        region = Region.objects.create(name=u'Saint-Denis', country=country,
+            geoname_code='974', geoname_id=6690283)
+        expected = City.objects.create(name=u'Sainte-Clotilde',
+            region=region)
+
+        command = Command()
+        command.setup(no_signals=True)
+        city = City(name=u'Sainte-Clotilde', region_id=region.pk)
+        command._city_prepare([city])
+
+        self.assertEqual(city.country_id, expected.country_id)
+        self.assertEqual(city.name_ascii, expected.name_ascii)
+        self.assertEqual(city.display_name, expected.display_name)
+        self.assertEqual(city.search_names, expected.search_names)
+        self.assertEqual(expected.search_names,
+            'sainteclotildereunion sainteclotildesaintdenisreunion')
+
+
+class DisplayNamePropagationTestCase(TestCase):
+    def testRenamesUpdateDependentRows(self):
+        country = Country.objects.create(name='Old country', code2='XD')
+        region = Region.objects.create(name='Old region', country=country)
+        City.objects.create(name='Town', country=country, region=region)
+        City.objects.create(name='Village', country=country)
+        other = Region.objects.create(name='Other region', country=country)
+        City.objects.create(name='Hamlet', country=country, region=other)
+
+        country = Country.objects.get(pk=country.pk)
+        country.name = 'New country'
+        # the country, its regions, its cities without and with region, then
+        # the names of their regions and country, their search_names and
+        # the update of those
+        with self.assertNumQueries(8):
+            country.save()
+
+        self.assertEqual(City.objects.get(name='Hamlet').display_name,
+            'Hamlet, Other region, New country')
+        self.assertIn('hamletnewcountry',
+            City.objects.get(name='Hamlet').search_names.split())
+
+        region = Region.objects.get(pk=region.pk)
+        region.name = 'New region'
+        region.save()
+
+        self.assertEqual(Region.objects.get(pk=region.pk).display_name,
+            'New region, New country')
+        self.assertEqual(sorted(City.objects.values_list('display_name',
+            flat=True)), ['Hamlet, Other region, New country',
+            'Town, New region, New country', 'Village, New country'])
+
+        region.alternate_names = 'Nouvelle region'
+        region.save()
+        self.assertIn('townnouvelleregionnewcountry',
+            City.objects.get(name='Town').search_names.split())
+
+
+class BuildPrefixesTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.command = cities_light_build_prefixes.Command()
+        self.command.batch_size = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, incremental):
+        self.command.fingerprints = Fingerprints(
+            os.path.join(self.directory, 'prefixes.fingerprints'))
+        if incremental:
+            self.command.fingerprints.load()
+
+        cities, prefixes = self.command.changed_cities()
+        self.command.write_relations(cities,
+            self.command.prefix_ids(prefixes), incremental)
+        self.command.fingerprints.save()
+        return cities
+
+    def prefixes(self, city):
+        return sorted(city.autocomplete_prefixes.values_list('prefix',
+            flat=True))
+
+    def testFullAndIncrementalBuild(self):
+        country = Country.objects.create(name='Prefix country', code2='XP')
+        region = Region.objects.create(name='Ab', country=country)
+        paris = City.objects.create(name='Paris', country=country,
+            region=region)
+        lyon = City.objects.create(name='Lyon', country=country)
+
+        self.build(False)
+        self.assertEqual(self.prefixes(paris),
+            ['par', 'pari', 'paris', 'parisa', 'parisab'])
+        self.assertEqual(self.prefixes(lyon), ['lyo', 'lyon'])
+
+        lyon.name = 'Lyons'
+        lyon.save()
+        self.assertEqual([c[0] for c in self.build(True)], [lyon.pk])
+        self.assertEqual(self.prefixes(lyon), ['lyo', 'lyon', 'lyons'])
+        self.assertEqual(len(self.prefixes(paris)), 5)
+
+
+class CityIndexTestCase(TestCase):
+    def testSearchRanksByPopulation(self):
+        # pks by decreasing population
+        cities = [(10, [u'Paris'], 'iledefrance', 'france'),
+            (11, [u'Parma'], 'emiliaromagna', 'italy'),
+            (12, [u'Paris'], 'texas', 'unitedstates'),
+            (13, [u'Pau', u'Pau Béarn'], '', 'france')]
+
+        entries = sorted((key, rank)
+            for rank, (pk, names, region, country) in enumerate(cities)
+            for key in city_keys(names, region, country))
+
+        class SmallCityIndex(CityIndex):
+            scan_limit = 2
+
+        index = SmallCityIndex([e[0] for e in entries],
+            [e[1] for e in entries], [c[0] for c in cities])
+
+        self.assertIn('p', index.top)
+        self.assertEqual(index.search(u'pa'), [10, 11, 12, 13])
+        self.assertEqual(index.search(u'par', 2), [10, 11])
+        self.assertEqual(index.search(u'Paris, Tex'), [12])
+        self.assertEqual(index.search(u'pau b'), [13])
+        self.assertEqual(index.search(u'paufrance'), [13])
+        self.assertEqual(index.search(u'lyon'), [])
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'autocomplete.index')
+            index.save(path)
+            mapped = CityIndex.open(path)
+
+            self.assertEqual(mapped.scan_limit, 2)
+            self.assertEqual(sorted(mapped.top.keys()),
+                sorted(index.top.keys()))
+            for q in (u'', u'pa', u'parma', u'Paris, Tex', u'pau b', u'x'):
+                self.assertEqual(mapped.search(q), index.search(q))
+            mapped.mmap.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def testMarkStaleRebuildsWithoutWriting(self):
+        builds = []
+
+        class FakeIndex(object):
+            @classmethod
+            def build(cls):
+                builds.append(cls())
+                return builds[-1]
+
+        version = data_version()
+        reloading = ReloadingIndex(FakeIndex)
+        reloading.check_interval = 60
+        self.assertTrue(reloading.get() is builds[0])
+
+        # the next use starts a rebuild in a thread
+        reloading.mark_stale()
+        reloading.get()
+        while reloading.building:
+            time.sleep(0.01)
+
+        self.assertEqual(len(builds), 2)
+        self.assertTrue(reloading.get() is builds[1])
+        self.assertEqual(data_version(), version)
+
+
+class SearchTestCase(TestCase):
+    def testSearchCitiesRankedByPopulation(self):
+        country = Country.objects.create(name='France', code2='FR')
+        region = Region.objects.create(name='Bretagne', country=country)
+        small = City.objects.create(name='Paris', country=country,
+            region=region, population=10)
+        big = City.objects.create(name='Paris', country=country,
+            population=2000000)
+        City.objects.create(name='Rennes', country=country, region=region)
+        get_backend().sync()
+
+        self.assertEqual(list(search_cities(u'Paris')), [big, small])
+        self.assertEqual(list(search_cities(u'paris bret')), [small])
+
+    def testMigrationFillsSearchNames(self):
+        migration = importlib.import_module(
+            'cities_light.migrations.0003_search_names')
+        country = Country.objects.create(name='France', code2='FR')
+        City.objects.create(name='Paris', country=country)
+        City.objects.update(search_names='')
+
+        migration.fill_search_names(apps, connection.schema_editor())
+        self.assertEqual(City.objects.get().search_names, 'parisfrance')
+
+    def testBackendsMatchWordPrefixes(self):
+        country = Country.objects.create(name='France', code2='FR')
+        paris = City.objects.create(name='Paris', country=country,
+            population=2000000)
+        City.objects.create(name='Rennes', country=country)
+
+        backends = [IcontainsSearchBackend]
+        if connection.vendor == 'sqlite':
+            backends.append(SQLiteSearchBackend)
+        elif connection.vendor == 'mysql':
+            backends.append(MySQLSearchBackend)
+
+        for backend_class in backends:
+            backend = backend_class(connection.alias)
+            backend.sync()
+            self.assertEqual(list(backend.search(City.objects.all(), u'par')),
+                [paris])
+
+        # only icontains matches inside words
+        self.assertEqual(list(IcontainsSearchBackend(connection.alias).search(
+            City.objects.all(), u'aris')), [paris])
+
+
+class CityTreeTestCase(TestCase):
+    def testNearestAndWithin(self):
+        cities = [(1, 2200000, 48.8566, 2.3522),  # Paris
+            (2, 1400000, 50.8503, 4.3517),  # Brussels
+            (3, 110000, 49.8941, 2.2958),  # Amiens
+            (4, 7000, -16.5, 179.9),  # Labasa, Fiji
+            (5, 1000, -16.8, -179.9)]  # Taveuni, across the antimeridian
+        tree = CityTree([(pk, population) + to_vector(lat, lon)
+            for pk, population, lat, lon in cities])
+
+        results = tree.nearest(49.0, 2.5, 2)
+        self.assertEqual([pk for pk, distance in results], [1, 3])
+        self.assertAlmostEqual(results[0][1], 19.2, 0)
+
+        self.assertEqual(tree.nearest(49.0, 2.5, 1, 1000000)[0][0], 1)
+        self.assertEqual(tree.nearest(50.0, 4.0, 1, 1500000)[0][0], 1)
+        self.assertEqual(tree.nearest(-16.8, 179.95, 1)[0][0], 5)
+        self.assertEqual(tree.nearest(49.0, 2.5, 0), [])
+        self.assertEqual([pk for pk, d in tree.within(49.5, 2.4, 100)],
+            [3, 1])
+        self.assertEqual(tree.within(0, 0, 100), [])
+
+
+class CityQuerySetTestCase(TestCase):
+    def testBboxAndRadius(self):
+        france = Country.objects.create(name='France', code2='FR')
+        fiji = Country.objects.create(name='Fiji', code2='FJ')
+        paris = City.objects.create(name='Paris', country=france,
+            latitude='48.85660', longitude='2.35220', population=2200000)
+        amiens = City.objects.create(name='Amiens', country=france,
+            latitude='49.89410', longitude='2.29580', population=110000)
+        labasa = City.objects.create(name='Labasa', country=fiji,
+            latitude='-16.50000', longitude='179.90000', population=7000)
+        taveuni = City.objects.create(name='Taveuni', country=fiji,
+            latitude='-16.80000', longitude='-179.90000', population=1000)
+        City.objects.create(name='Nowhere', country=fiji)
+
+        self.assertEqual(list(City.objects.in_bbox(48, 2, 50, 3)),
+            [paris, amiens])
+        self.assertEqual(list(City.objects.in_bbox(-17, 179, -16, -179)),
+            [labasa, taveuni])
+
+        cities = City.objects.within_radius(49.5, 2.4, 100)
+        self.assertEqual(cities, [paris, amiens])
+        self.assertAlmostEqual(cities[1].distance, 44.5, 0)
+        self.assertEqual(City.objects.within_radius(-16.8, 179.95, 20),
+            [taveuni])
+
+
+class FingerprintsTestCase(TestCase):
+    def testUnchangedRowsAcrossImports(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(path)
+
+        fingerprints = Fingerprints(path).load()
+        self.assertEqual(fingerprints.check(1, ['1', 'Paris']),
+            Fingerprints.NEW)
+        fingerprints.check(2, ['2', 'Lyon'])
+        fingerprints.save()
+
+        fingerprints = Fingerprints(path).load()
+        self.assertEqual(fingerprints.check(1, ['1', 'Paris']),
+            Fingerprints.UNCHANGED)
+        self.assertEqual(fingerprints.check(2, ['2', 'Lyons']),
+            Fingerprints.CHANGED)
+        self.assertEqual(fingerprints.counts, {Fingerprints.NEW: 0,
+            Fingerprints.CHANGED: 1, Fingerprints.UNCHANGED: 1})
+
+        os.unlink(path)
+
+
+@skipIf(restframework is None, 'djangorestframework is not installed')
+class CityNearestViewTestCase(TestCase):
+    def setUp(self):
+        france = Country.objects.create(name='France', code2='FR')
+        self.paris = City.objects.create(name='Paris', country=france,
+            latitude='48.85660', longitude='2.35220', population=2200000)
+        self.amiens = City.objects.create(name='Amiens', country=france,
+            latitude='49.89410', longitude='2.29580', population=110000)
+
+        self.addCleanup(setattr, spatial, 'nearest', spatial.nearest)
+        spatial.nearest = self.nearest
+
+        class View(restframework.CityNearestView):
+            # no url to reverse in the test urlconf
+            def city_data(self, city, distance):
+                return city.name
+
+        self.view = View()
+
+    def nearest(self, latitude, longitude, k=1, min_population=None):
+        cities = [(self.paris.pk, 10.0), (self.amiens.pk, 20.0)]
+        if latitude > 49.5:
+            cities.reverse()
+        return cities[:k]
+
+    def assertBadRequest(self, data):
+        self.assertRaises(restframework.ErrorResponse, self.view.nearest,
+            data)
+
+    def testPosition(self):
+        self.assertEqual(self.view.nearest({'lat': '48.9', 'lon': '2.4',
+            'k': '2'}), ['Paris', 'Amiens'])
+
+    def testBatch(self):
+        self.assertEqual(self.view.nearest({'coordinates': '48.9,2.4;50,2.3'}),
+            [['Paris'], ['Amiens']])
+        self.assertEqual(self.view.nearest({'coordinates': [[48.9, 2.4],
+            ['50', '2.3']]}), [['Paris'], ['Amiens']])
+
+    def testBareCoordinatesList(self):
+        self.view.DATA = [[50, 2.3]]
+        self.assertEqual(self.view.post(RequestFactory().post(
+            '/city/nearest/?k=2')), [['Amiens', 'Paris']])
+
+        self.view.DATA = '12'
+        self.assertRaises(restframework.ErrorResponse, self.view.post,
+            RequestFactory().post('/city/nearest/'))
+
+    def testInvalidArguments(self):
+        for k in ('0', '-1', '101', 'two'):
+            self.assertBadRequest({'lat': '48.9', 'lon': '2.4', 'k': k})
+
+        self.assertBadRequest({'lat': '48.9'})
+        self.assertBadRequest({'lat': '91', 'lon': '2.4'})
+        self.assertBadRequest({'coordinates': '48.9;2.4'})
+        self.assertBadRequest({'coordinates': '48.9,2.4,1'})
+        self.assertBadRequest({'coordinates': 12})
+        # strings are not pairs, even if they have two characters
+        self.assertBadRequest({'coordinates': ['12', '34']})
+        self.assertBadRequest({'coordinates': [[True, 2.4]]})
+        self.assertBadRequest({'coordinates': [['north', 'east']]})
+
+
+@skipIf(restframework is None, 'djangorestframework is not installed')
+class CityListLimitTestCase(TestCase):
+    def testLimit(self):
+        view = restframework.CityListModelView()
+        factory = RequestFactory()
+
+        self.assertEqual(view.limit(factory.get('/city/'), 10), 10)
+        self.assertEqual(view.limit(factory.get('/city/?limit=5'), 10), 5)
+        for limit in ('0', '-1', 'ten'):
+            self.assertRaises(restframework.ErrorResponse, view.limit,
+                factory.get('/city/?limit=%s' % limit))
@@ -0,0 +1,268 @@
+"""
+Bounded-memory buffer for parsed alternate names.
+
+The cities_light command used to hold every translation of alternateNames.txt
+in a nested dict until the end of parsing. TranslationBuffer keeps entries in
+memory until an approximate budget of TRANSLATION_MEMORY_LIMIT megabytes is
+reached, then sorts them and spills them to a temporary run file in DATA_DIR.
+Iterating over the buffer merges the runs and yields the names of one
+geoname_id at a time, so peak memory does not depend on the size of the dump
+nor on the number of TRANSLATION_LANGUAGES.
+
+TranslationCache stores the grouped translations in a versioned file which
+can be memory-mapped and iterated without loading it, for --hack-translations.
+"""
+
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from .models import Country, Region, City
+from .settings import *
+
+__all__ = ['TranslationBuffer', 'TranslationCache']
+
+MODELS = dict((m.__name__, m) for m in (Country, Region, City))
+
+
+class TranslationBuffer(object):
+    """
+    Collect (model_class, geoname_id, lang, name) entries, iterate them back
+    grouped as (model_class, geoname_id, {lang: [name, ...]}).
+
+    Names of a group keep the order in which they were added.
+    """
+
+    # rough cost in bytes of one buffered entry, on top of the name
+    entry_overhead = 200
+
+    def __init__(self, memory_limit=None, directory=None):
+        if memory_limit is None:
+            memory_limit = TRANSLATION_MEMORY_LIMIT
+        self.memory_limit = memory_limit * 1024 * 1024
+        self.directory = directory or DATA_DIR
+
+        self.entries = []
+        self.size = 0
+        self.runs = []
+        self.count = 0
+
+    def add(self, model_class, geoname_id, lang, name):
+        """
+        Buffer one alternate name, spill to disk if over budget.
+        """
+        self.entries.append((model_class.__name__, geoname_id, self.count,
+            lang, name))
+        self.count += 1
+        self.size += self.entry_overhead + len(name)
+
+        if self.size >= self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        """
+        Write the buffered entries, sorted, to a new run file.
+        """
+        if not self.entries:
+            return
+
+        self.entries.sort()
+
+        run = tempfile.TemporaryFile(dir=self.directory,
+            prefix='translations')
+        for entry in self.entries:
+            run.write((u'%s\t%d\t%d\t%s\t%s\n' % entry).encode('utf-8'))
+
+        self.runs.append(run)
+        self.entries = []
+        self.size = 0
+
+    def read_run(self, run):
+        run.seek(0)
+        for line in run:
+            model_name, geoname_id, seq, lang, name = line.decode(
+                'utf-8').rstrip(u'\n').split(u'\t', 4)
+            yield model_name, int(geoname_id), int(seq), lang, name
+
+    def __iter__(self):
+        self.entries.sort()
+        streams = [self.read_run(run) for run in self.runs]
+        streams.append(iter(self.entries))
+
+        groups = itertools.groupby(heapq.merge(*streams),
+            key=lambda entry: entry[:2])
+
+        for (model_name, geoname_id), entries in groups:
+            data = {}
+            for entry in entries:
+                data.setdefault(entry[3], []).append(entry[4])
+
+            yield MODELS[model_name], geoname_id, data
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        """
+        Delete the run files.
+        """
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.entries = []
+
+
+class TranslationCache(object):
+    """
+    Versioned on-disk copy of parsed translations, for --hack-translations.
+
+    The file starts with MAGIC, the format version and the offset of the
+    header (struct '<4sHQ'). Then come the groups of a TranslationBuffer, one
+    record per geoname_id: struct '<iI' for geoname_id and payload length,
+    then the UTF-8 payload with one 'lang<TAB>name<TAB>name...' line per
+    language. Records are contiguous per model. The JSON header at the end
+    holds the source file mtime and size, the language set, and the (start,
+    end, number of names) of each model's records.
+
+    Readers mmap the file and decode one record at a time. The cache is
+    valid only for the source file and languages it was written from.
+    """
+
+    magic = 'CLTC'
+    version = 1
+    prefix = struct.Struct('<4sHQ')
+    record = struct.Struct('<iI')
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.mmap = None
+
+    @classmethod
+    def fingerprint(cls, source_path, languages):
+        """
+        Return what the header must match for the cache to be valid.
+        """
+        stat = os.stat(source_path)
+        return {
+            'source_mtime': int(stat.st_mtime),
+            'source_size': stat.st_size,
+            'languages': sorted(set(languages)),
+        }
+
+    def write(self, groups, source_path, languages):
+        """
+        Write groups, as yielded by TranslationBuffer, then atomically
+        replace the cache file.
+        """
+        header = self.fingerprint(source_path, languages)
+        header['models'] = models = {}
+        header['count'] = 0
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.prefix.pack(self.magic, self.version, 0))
+
+            for model_class, geoname_id, data in groups:
+                section = models.setdefault(model_class.__name__,
+                    [f.tell(), f.tell(), 0])
+
+                payload = u'\n'.join(u'\t'.join([lang] + names)
+                    for lang, names in data.items()).encode('utf-8')
+                f.write(self.record.pack(geoname_id, len(payload)))
+                f.write(payload)
+
+                names = sum(len(n) for n in data.values())
+                section[1] = f.tell()
+                section[2] += names
+                header['count'] += names
+
+            header_offset = f.tell()
+            f.write(json.dumps(header))
+
+            f.seek(0)
+            f.write(self.prefix.pack(self.magic, self.version, header_offset))
+
+        os.rename(tmp_path, self.path)
+
+    def open(self):
+        """
+        Map the file and read its header, return self. Raise ValueError if
+        the file is not a cache of this version.
+        """
+        with open(self.path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, header_offset = self.prefix.unpack_from(
+                self.mmap, 0)
+        except struct.error:
+            magic = version = None
+
+        if magic != self.magic or version != self.version:
+            self.close()
+            raise ValueError('%s is not a translation cache version %s' % (
+                self.path, self.version))
+
+        self.header = json.loads(self.mmap[header_offset:])
+        return self
+
+    def is_valid(self, source_path, languages):
+        """
+        Return True if the cache exists and was written from source_path, as
+        it is now, and the same languages.
+        """
+        if not os.path.exists(self.path) or not os.path.exists(source_path):
+            return False
+
+        try:
+            self.open()
+        except (ValueError, EnvironmentError):
+            return False
+
+        fingerprint = self.fingerprint(source_path, languages)
+        valid = all(self.header.get(key) == value
+            for key, value in fingerprint.items())
+
+        self.close()
+        return valid
+
+    def iter_model(self, model_class):
+        """
+        Yield (geoname_id, {lang: [name, ...]}) for the records of
+        model_class.
+        """
+        start, end = self.header['models'].get(model_class.__name__,
+            (0, 0, 0))[:2]
+
+        position = start
+        while position < end:
+            geoname_id, length = self.record.unpack_from(self.mmap, position)
+            position += self.record.size
+
+            data = {}
+            payload = self.mmap[position:position + length].decode('utf-8')
+            for line in payload.split(u'\n'):
+                names = line.split(u'\t')
+                data[names[0]] = names[1:]
+            position += length
+
+            yield geoname_id, data
+
+    def __iter__(self):
+        for model_name in sorted(self.header['models'].keys()):
+            model_class = MODELS[model_name]
+            for geoname_id, data in self.iter_model(model_class):
+                yield model_class, geoname_id, data
+
+    def __len__(self):
+        return self.header['count']
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None